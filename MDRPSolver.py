@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Illegal path elimination callback and its telemetry, export and loading of
+built models, and tuned solver parameters
+
+The callback needs the arcs and untimed arc data of the model it is solving.
+These are given to SetupCallback by Optimisation Code.py after building the
+model, or are loaded back from the sidecar file of an exported model.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import pickle
+from collections import defaultdict
+from time import time
+from gurobipy import Model, quicksum, GRB, read
+
+# Set by SetupCallback
+m = None
+arcs = {} # timedArc: variable
+untimedArcData = {}
+arcsByUntimedArc = {}
+untimedArcsByCourierRestaurant = {}
+untimedArcsByCourierNextRestaurant = {}
+courierGroups = {}
+courierData = {}
+courierMultiplicity = {} # courier class representative: number of couriers in the class
+payPerDelivery = 0
+minPayPerHour = 0
+
+def SetupCallback(model, modelArcs, modelData):
+    """
+    Point the callback at a model
+    modelArcs is {timedArc: variable}
+    modelData is a dictionary holding untimedArcData, arcsByUntimedArc,
+    untimedArcsByCourierRestaurant, untimedArcsByCourierNextRestaurant,
+    courierGroups, courierData, courierMultiplicity, payPerDelivery and
+    minPayPerHour
+    The collections are kept, not copied, so arcs added to them later are seen
+    by the callback.
+    """
+    global m, arcs
+    m = model
+    arcs = modelArcs
+    globals().update(modelData)
+
+callbackCuts = []
+lazyVICuts = []
+def ComputeAndRemoveMinimalIllegalNetwork(listOfTimedArcs, timedArcValues):
+    # Take the list of timed arcs, and convert them to untimed arcs
+    # An entry arc of a courier class can be used by more than one of its
+    # couriers, so each untimed arc keeps how many times it is used
+    usedUntimedArcs = []
+    usedCouriers = set()
+    untimedArcValues = {}
+    for arc in listOfTimedArcs:
+        ((g,c), _, _, s, r2, _) = arc
+        untimedArc = ((g,c), s, r2)
+        if untimedArc in usedUntimedArcs:
+            print('Error! Duplicate use of untimed arc in solution!', untimedArc)
+        usedUntimedArcs.append(untimedArc)
+        untimedArcValues[untimedArc] = max(1, round(timedArcValues[arc]))
+        if c != 0:
+            usedCouriers.add(c)
+    
+    # Find all possible predecessor-successor pairs
+    successorsForArc = defaultdict(list)
+    predecessorsForArc = defaultdict(list)
+    for (arc1, arc2) in itertools.combinations(usedUntimedArcs, 2):
+        arc1Data = untimedArcData[arc1]
+        arc2Data = untimedArcData[arc2]
+        if arc1Data[1] + arc1Data[3] <= arc2Data[2] and arc1[2] == arc2Data[0] and arc1[2] != 0:
+            # Earliest arrival before latest departure
+            # The arrival location of the first arc is the departure location of the second
+            # The first arc does not head home
+            successorsForArc[arc1].append(arc2)
+            predecessorsForArc[arc2].append(arc1)
+        if arc2Data[1] + arc2Data[3] <= arc1Data[2] and arc2[2] == arc1Data[0] and arc2[2] != 0:
+            successorsForArc[arc2].append(arc1)
+            predecessorsForArc[arc1].append(arc2)
+    successorsForArc = dict(successorsForArc)
+    predecessorsForArc = dict(predecessorsForArc)
+    
+    # Add lazy constraints to ensure that all used arcs have successors and predecessors
+    for arc in usedUntimedArcs:
+        if arc not in successorsForArc and arc[2] != 0:
+            earliestArrival = untimedArcData[arc][1] + untimedArcData[arc][3]
+            arrivalRestaurant = arc[2]
+            group = arc[0][0]
+            successors = []
+            for arc2 in untimedArcData:
+                if arc2[0][0] == group and untimedArcData[arc2][0] == arrivalRestaurant and untimedArcData[arc2][2] >= earliestArrival:
+                    successors.append(arc2)
+            if len(successors) == 0:
+                print('Error! Untimed arc has no successors!', arc)
+            m.cbLazy(quicksum(arcs[timedArc] for untimedArc in successors for timedArc in arcsByUntimedArc[untimedArc]) == quicksum(arcs[timedArc] for timedArc in arcsByUntimedArc[arc]))
+            lazyVICuts.append((1, arc, successors))
+        if arc not in predecessorsForArc and arc[1] != ():
+            latestDeparture = untimedArcData[arc][2]
+            departureRestaurant = untimedArcData[arc][0]
+            group = arc[0][0]
+            predecessors = []
+            for arc2 in untimedArcData:
+                if arc2[0][0] == group and arc2[2] == departureRestaurant and untimedArcData[arc2][1] + untimedArcData[arc2][3] <= latestDeparture:
+                    predecessors.append(arc2)
+            if len(predecessors) == 0:
+                print('Error! Untimed arc has no predecessors!', arc)
+            m.cbLazy(quicksum(arcs[timedArc] for untimedArc in predecessors for timedArc in arcsByUntimedArc[untimedArc]) == quicksum(arcs[timedArc] for timedArc in arcsByUntimedArc[arc]))
+            lazyVICuts.append((-1, arc, predecessors))
+            
+    # Create a new model
+    IPD = Model('Illegal Path Determination')
+    X = {(arc, successor): IPD.addVar(vtype=GRB.BINARY) for arc in successorsForArc for successor in successorsForArc[arc]}
+    Y = {(courier, arc): IPD.addVar(vtype=GRB.BINARY) for courier in usedCouriers for arc in usedUntimedArcs}
+    Z = {courier: IPD.addVar() for courier in usedCouriers}
+    T = {arc: IPD.addVar() for arc in usedUntimedArcs}
+    # T constraints
+    leaveAfterEarlyTime = {arc: IPD.addConstr(T[arc] >= untimedArcData[arc][1]) for arc in usedUntimedArcs}
+    leaveBeforeLateTime = {arc: IPD.addConstr(T[arc] <= untimedArcData[arc][2]) for arc in usedUntimedArcs}
+    # X constraints
+    enoughTimeForBothArcs = {(i,j): IPD.addConstr(T[i]+untimedArcData[i][3] <= T[j] + 
+                                  (untimedArcData[i][2]+untimedArcData[i][3]-untimedArcData[j][1])*(1-X[i,j]))
+                              for (i,j) in X}
+    predecessorArcsUsedOnce = {i: IPD.addConstr(quicksum(X[i,j] for j in successorsForArc[i]) == untimedArcValues[i]) for i in successorsForArc}
+    successorArcsUsedOnce = {j: IPD.addConstr(quicksum(X[i,j] for i in predecessorsForArc[j]) == untimedArcValues[j]) for j in predecessorsForArc}
+    # Y constraints
+    oneCourierDeliversPair = {}
+    for courier in usedCouriers:
+        for (arc, successor) in X:
+            oneCourierDeliversPair[(courier, arc, successor)] = IPD.addConstr(X[arc, successor] + Y[courier, arc] - 1 <= Y[courier, successor])
+    eachArcOneCourier = {arc: IPD.addConstr(quicksum(Y[courier, arc] for courier in usedCouriers) == 1) for arc in usedUntimedArcs if arc[0][1] == 0}
+    # A courier class can start on more than one entry arc
+    eachCourierOwnStart = {arc: IPD.addConstr(Y[arc[0][1], arc] == 1) for arc in usedUntimedArcs if arc[0][1] != 0}
+    # Z constraints
+    courierPayPerDelivery = {}
+    for courier in usedCouriers:
+        courierPayPerDelivery[courier] = IPD.addConstr(Z[courier] >= quicksum(Y[courier, arc] * len(arc[1]) * payPerDelivery for arc in usedUntimedArcs))
+    courierPayPerTime = {courier: IPD.addConstr(Z[courier] >= (courierData[courier][3] - courierData[courier][2]) * minPayPerHour / 60 * courierMultiplicity.get(courier, 1)) for courier in usedCouriers}
+    # Objective
+    IPD.setObjective(quicksum(Z[courier] for courier in usedCouriers))
+    
+    # Solve the model
+    IPD.setParam('OutputFlag', 0)
+    IPD.optimize()
+    
+    # Compute IIS
+    if IPD.Status == GRB.INFEASIBLE:
+        IPD.computeIIS()
+    
+        # Compute Invalid Network
+        invalidUntimedArcs = set()
+        for arc in usedUntimedArcs:
+            if leaveAfterEarlyTime[arc].IISConstr or leaveBeforeLateTime[arc].IISConstr:
+                invalidUntimedArcs.add(arc)
+        for predecessor, successor in X:
+            if enoughTimeForBothArcs[predecessor, successor].IISConstr:
+                invalidUntimedArcs.add(predecessor)
+                invalidUntimedArcs.add(successor)
+            else:
+                if predecessorArcsUsedOnce[predecessor].IISConstr:
+                    invalidUntimedArcs.add(predecessor)
+                if successorArcsUsedOnce[successor].IISConstr:
+                    invalidUntimedArcs.add(successor)
+        
+        # Find possible replacement arcs
+        alternatePredecessorArcs = set()
+        alternateSuccessorArcs = set()
+        for arc in invalidUntimedArcs:
+            (group, _), _, arrivalRestaurant = arc
+            departureRestaurant, earliestLeavingTime, latestLeavingTime, travelTime = untimedArcData[arc]
+            for untimedArc in untimedArcsByCourierNextRestaurant[group, departureRestaurant]:
+                if untimedArc not in usedUntimedArcs:
+                    # Finding predecessors. A valid predecessor will have earliest
+                    # arrival time before the arc has to leave
+                    earliestArrival = untimedArcData[untimedArc][1] + untimedArcData[untimedArc][3]
+                    if earliestArrival <= latestLeavingTime:
+                        alternatePredecessorArcs.add(untimedArc)
+            
+            for untimedArc in untimedArcsByCourierRestaurant[group, arrivalRestaurant]:
+                if untimedArc not in usedUntimedArcs:
+                    # Finding successors. A valid successor will have latest leaving
+                    # time after the arc's earliest arrival
+                    earliestArrival = earliestLeavingTime + travelTime
+                    if earliestArrival <= untimedArcData[untimedArc][2]:
+                        alternateSuccessorArcs.add(untimedArc)
+        
+        # Remove Invalid Network, at the level each of its arcs is used
+        invalidNetworkValue = sum(untimedArcValues[arc] for arc in invalidUntimedArcs)
+        m.cbLazy(quicksum(arcs[timedArc] for untimedArc in invalidUntimedArcs for timedArc in arcsByUntimedArc[untimedArc])
+                  <= invalidNetworkValue - 1 + quicksum(arcs[timedArc] for untimedArc in alternatePredecessorArcs for timedArc in arcsByUntimedArc[untimedArc]))
+        m.cbLazy(quicksum(arcs[timedArc] for untimedArc in invalidUntimedArcs for timedArc in arcsByUntimedArc[untimedArc])
+                  <= invalidNetworkValue - 1 + quicksum(arcs[timedArc] for untimedArc in alternateSuccessorArcs for timedArc in arcsByUntimedArc[untimedArc]))
+        callbackCuts.append((-1, invalidUntimedArcs, alternatePredecessorArcs))
+        callbackCuts.append((1, invalidUntimedArcs, alternateSuccessorArcs))
+
+# ============================================================================
+# Telemetry
+# Solve progress is written to a tab separated file, one event per line, and
+# flushed as it goes so it can be followed with tail -f. Columns are:
+# time, event, bound, incumbent, gap, candidate, nodes, group, callbackTime,
+# lazyVICuts, illegalNetworkCuts, message
+# Events are:
+# - progress: bound, incumbent, gap and nodes, from MIP and MIPNODE callbacks,
+#   at most once every telemetryInterval seconds
+# - incumbent: the same, for every MIPSOL callback, along with the objective of
+#   the candidate solution, which the callback may still cut off
+# - group: time spent and cuts added by the callback for one courier group in
+#   a MIPSOL callback
+# - callback: total time spent and cuts added in a MIPSOL callback
+# - message: a line of the Gurobi log
+# ============================================================================
+
+telemetryFile = None
+telemetryStartTime = 0
+telemetryInterval = 1 # seconds between progress events
+lastProgressTime = -telemetryInterval
+
+def StartTelemetry(telemetryPath, interval=1):
+    # Start writing telemetry for the next solves to telemetryPath
+    global telemetryFile, telemetryStartTime, telemetryInterval, lastProgressTime
+    StopTelemetry()
+    telemetryFile = open(telemetryPath, 'w')
+    telemetryStartTime = time()
+    telemetryInterval = interval
+    lastProgressTime = -interval
+    telemetryFile.write('time\tevent\tbound\tincumbent\tgap\tcandidate\tnodes\tgroup\tcallbackTime\tlazyVICuts\tillegalNetworkCuts\tmessage\n')
+    telemetryFile.flush()
+
+def StopTelemetry():
+    global telemetryFile
+    if telemetryFile is not None:
+        telemetryFile.close()
+        telemetryFile = None
+
+def WriteTelemetry(event, bound='', incumbent='', nodes='', candidate='', group='', callbackTime='', lazyVICutCount='', illegalNetworkCutCount='', message=''):
+    gap = ''
+    if bound != '' and incumbent != '' and abs(incumbent) < GRB.INFINITY and incumbent != 0:
+        gap = '%.6g' % (abs(incumbent - bound) / abs(incumbent))
+    values = ['%.3f' % (time() - telemetryStartTime), event, bound, incumbent, gap, candidate, nodes, group, callbackTime, lazyVICutCount, illegalNetworkCutCount, message]
+    telemetryFile.write('\t'.join(value if type(value) == str else '%.6g' % value for value in values) + '\n')
+    telemetryFile.flush()
+
+def RecordProgress(model, where):
+    global lastProgressTime
+    if time() - lastProgressTime < telemetryInterval:
+        return
+    lastProgressTime = time()
+    if where == GRB.Callback.MIP:
+        WriteTelemetry('progress', model.cbGet(GRB.Callback.MIP_OBJBND), model.cbGet(GRB.Callback.MIP_OBJBST), model.cbGet(GRB.Callback.MIP_NODCNT))
+    else:
+        WriteTelemetry('progress', model.cbGet(GRB.Callback.MIPNODE_OBJBND), model.cbGet(GRB.Callback.MIPNODE_OBJBST), model.cbGet(GRB.Callback.MIPNODE_NODCNT))
+
+def Callback(model, where):
+    if where == GRB.Callback.MIPSOL:
+        callbackStartTime = time()
+        lazyVICutsBefore, callbackCutsBefore = len(lazyVICuts), len(callbackCuts)
+        timedArcValues = {arc: value for (arc, value) in zip(arcs.keys(), model.cbGetSolution(list(arcs.values())))}
+        usedTimedArcs = {arc: timedArcValues[arc] for arc in timedArcValues if timedArcValues[arc] > 0.01}
+        usedArcsByGroup = {group: [] for group in courierGroups}
+        for arc in usedTimedArcs:
+            if arc[3] != () or arc[1] != arc[4]:
+                usedArcsByGroup[arc[0][0]].append(arc)
+        if telemetryFile is not None:
+            WriteTelemetry('incumbent', model.cbGet(GRB.Callback.MIPSOL_OBJBND), model.cbGet(GRB.Callback.MIPSOL_OBJBST), model.cbGet(GRB.Callback.MIPSOL_NODCNT),
+                           candidate=model.cbGet(GRB.Callback.MIPSOL_OBJ))
+        for group in usedArcsByGroup:
+            if len(usedArcsByGroup[group]) > 0:
+                groupStartTime = time()
+                groupLazyVICutsBefore, groupCallbackCutsBefore = len(lazyVICuts), len(callbackCuts)
+                ComputeAndRemoveMinimalIllegalNetwork(usedArcsByGroup[group], usedTimedArcs)
+                if telemetryFile is not None:
+                    WriteTelemetry('group', group=str(group), callbackTime=time() - groupStartTime,
+                                   lazyVICutCount=len(lazyVICuts) - groupLazyVICutsBefore, illegalNetworkCutCount=len(callbackCuts) - groupCallbackCutsBefore)
+        if telemetryFile is not None:
+            WriteTelemetry('callback', callbackTime=time() - callbackStartTime,
+                           lazyVICutCount=len(lazyVICuts) - lazyVICutsBefore, illegalNetworkCutCount=len(callbackCuts) - callbackCutsBefore)
+    elif telemetryFile is not None:
+        if where == GRB.Callback.MIP or where == GRB.Callback.MIPNODE:
+            RecordProgress(model, where)
+        elif where == GRB.Callback.MESSAGE:
+            message = model.cbGet(GRB.Callback.MSG_STRING).strip().replace('\t', ' ')
+            if message != '':
+                WriteTelemetry('message', message=message)
+
+def ExportModel(exportPath):
+    """
+    Write the model given to SetupCallback to exportPath + '.mps.bz2', along
+    with the timed arc of each variable and the callback's data in
+    exportPath + '.arcs.pkl.gz'
+    """
+    if os.path.dirname(exportPath) != '':
+        os.makedirs(os.path.dirname(exportPath), exist_ok=True)
+    m.update()
+    m.write(exportPath + '.mps.bz2')
+    sidecar = {
+        'arcs': list(arcs),
+        'arcIndices': [arcs[arc].index for arc in arcs],
+        'untimedArcData': untimedArcData,
+        'arcsByUntimedArc': arcsByUntimedArc,
+        'untimedArcsByCourierRestaurant': untimedArcsByCourierRestaurant,
+        'untimedArcsByCourierNextRestaurant': untimedArcsByCourierNextRestaurant,
+        'courierGroups': courierGroups,
+        'courierData': courierData,
+        'courierMultiplicity': courierMultiplicity,
+        'payPerDelivery': payPerDelivery,
+        'minPayPerHour': minPayPerHour
+    }
+    with gzip.open(exportPath + '.arcs.pkl.gz', 'wb') as file:
+        pickle.dump(sidecar, file, pickle.HIGHEST_PROTOCOL)
+
+def LoadExportedModel(exportPath, env=None):
+    """
+    Read a model written by ExportModel, and set up the callback for it
+    Returns (model, {timedArc: variable})
+    """
+    model = read(exportPath + '.mps.bz2', env)
+    with gzip.open(exportPath + '.arcs.pkl.gz', 'rb') as file:
+        sidecar = pickle.load(file)
+    variables = model.getVars()
+    modelArcs = {arc: variables[index] for (arc, index) in zip(sidecar.pop('arcs'), sidecar.pop('arcIndices'))}
+    SetupCallback(model, modelArcs, sidecar)
+    return (model, modelArcs)
+
+def ExportFirstRoundLP(model, exportPath):
+    """
+    Write the LP relaxation as it is before any VIs are added, to exportPath +
+    '.lp.bz2', for Tune Solver Parameters.py to tune the VI round parameters on
+    """
+    if os.path.dirname(exportPath) != '':
+        os.makedirs(os.path.dirname(exportPath), exist_ok=True)
+    model.update()
+    model.write(exportPath + '.lp.bz2')
+
+def LoadExportedFirstRoundLP(exportPath, env=None):
+    # Returns None for models exported without their first round LP
+    if not os.path.exists(exportPath + '.lp.bz2'):
+        return None
+    return read(exportPath + '.lp.bz2', env)
+
+def SizeClass(numVars):
+    # Tuned parameters are kept per size class, by number of model variables
+    if numVars < 50000:
+        return 'small'
+    elif numVars < 500000:
+        return 'medium'
+    return 'large'
+
+def ApplyTunedParameters(model, stage, parametersFile='TunedParameters.json'):
+    """
+    Set the parameters found by Tune Solver Parameters.py for the model's
+    size class. stage is 'LP' for the VI rounds, or 'MIP' for the final solve.
+    Does nothing if there is no parameters file, or nothing tuned for the
+    size class.
+    """
+    if not os.path.exists(parametersFile):
+        return
+    with open(parametersFile) as file:
+        tunedParameters = json.load(file)
+    model.update()
+    for (parameter, value) in tunedParameters.get(SizeClass(model.NumVars), {}).get(stage, {}).items():
+        model.setParam(parameter, value)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the data built by Optimisation Code.py, and comparisons between runs
+
+ValidateStages checks the invariants of every stage, from the bundles to the
+timed arcs. It is given the script's globals, and is called before the model
+is built when validateStages is on.
+
+Run on its own, this generates small random instances, and runs the script on
+each one up to the model, with the reference settings and with each of
+fastEngineSettings. The reference run is validated, and each fast run must
+build the same bundles, pairs, untimed arcs and timed arcs as it.
+
+Usage: python MDRPValidation.py [instance count]
+"""
+
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+from itertools import combinations
+
+randomInstanceCount = 5
+referenceSettings = {}
+fastEngineSettings = [
+    {'useSpatialIndex': True},
+    {'useSpatialIndex': True, 'spatialIndexCellSize': 250},
+    {'lowMemoryMode': True}
+]
+maxProblemsShown = 10 # per check
+
+# ============================================================================
+# Stage invariants
+# Each check takes the script's globals, and returns a list of problems. Checks
+# of data that isn't there (such as after lowMemoryMode frees it) are skipped.
+# ============================================================================
+
+def CheckBundleTiming(ns):
+    """
+    Every bundle leaves from the restaurant of its orders, no earlier than its
+    last ready time, and its latest leaving time and travel time match those
+    found by following the bundle order by order
+    """
+    problems = []
+    orderData, restaurantData, TravelTime = ns['orderData'], ns['restaurantData'], ns['TravelTime']
+    for bundle, (restaurant, earliestLeavingTime, latestLeavingTime, travelTime) in ns['sequenceData'].items():
+        if latestLeavingTime < earliestLeavingTime:
+            problems.append(('leaves after its latest leaving time', bundle))
+        if max(orderData[order][4] for order in bundle) != earliestLeavingTime:
+            problems.append(('earliest leaving time is not the last ready time', bundle))
+        if len(set(bundle)) != len(bundle):
+            problems.append(('repeats an order', bundle))
+        totalTravelTime = 0
+        latestDepartureTime = ns['globalOffTime']
+        location = restaurantData[restaurant]
+        for (i, order) in enumerate(bundle):
+            if orderData[order][3] != restaurant:
+                problems.append(('order from another restaurant', bundle))
+            if i == 0:
+                totalTravelTime += TravelTime(location, orderData[order]) + (ns['pickupServiceTime'] + ns['dropoffServiceTime']) / 2
+            else:
+                totalTravelTime += TravelTime(location, orderData[order]) + ns['dropoffServiceTime']
+            location = orderData[order]
+            latestDepartureTime = min(latestDepartureTime, orderData[order][6] - totalTravelTime)
+        if latestDepartureTime != latestLeavingTime:
+            problems.append(('latest leaving time does not match its orders', bundle))
+        if totalTravelTime != travelTime:
+            problems.append(('travel time does not match its orders', bundle))
+    return problems
+
+def CheckPairDominance(ns):
+    """
+    Every pair is made from a bundle and matches its data, and no pair is
+    dominated by a pair with the same order set and next restaurant
+    """
+    problems = []
+    sequenceData, orderData, TravelTime = ns['sequenceData'], ns['orderData'], ns['TravelTime']
+    pairsByOrderSetAndRestaurant = {}
+    for (sequence, restaurant), pairData in ns['sequenceNextRestaurantData'].items():
+        pairsByOrderSetAndRestaurant.setdefault((frozenset(sequence), restaurant), []).append((sequence, restaurant))
+        if sequence not in sequenceData:
+            problems.append(('pair for a removed bundle', (sequence, restaurant)))
+            continue
+        travelTime = sequenceData[sequence][3] + TravelTime(orderData[sequence[-1]], ns['restaurantData'][restaurant]) + (ns['dropoffServiceTime'] + ns['pickupServiceTime']) / 2
+        if pairData != sequenceData[sequence][:3] + [travelTime]:
+            problems.append(('pair data does not match its bundle', (sequence, restaurant)))
+    for pairs in pairsByOrderSetAndRestaurant.values():
+        for (pair1, pair2) in combinations(pairs, 2):
+            data1, data2 = ns['sequenceNextRestaurantData'][pair1], ns['sequenceNextRestaurantData'][pair2]
+            if (data1[2] < data2[2] and data1[3] > data2[3]) or (data2[2] < data1[2] and data2[3] > data1[3]):
+                problems.append(('dominated pair kept', (pair1, pair2)))
+    return problems
+
+def CheckUntimedArcWindows(ns):
+    """
+    Every untimed arc has a departure window, entry arcs belong to a courier
+    and leave from home, and other arcs leave from their bundle's restaurant
+    within the group's shift, no earlier than their orders are ready
+    """
+    problems = []
+    orderData, courierGroups = ns['orderData'], ns['courierGroups']
+    for arc, (restaurant, earliestLeavingTime, latestLeavingTime, travelTime) in ns['untimedArcData'].items():
+        ((g, c), sequence, nextRestaurant) = arc
+        if earliestLeavingTime > latestLeavingTime:
+            problems.append(('empty departure window', arc))
+        if travelTime < 0:
+            problems.append(('negative travel time', arc))
+        if sequence == ():
+            if c == 0 or restaurant != 0 or nextRestaurant == 0:
+                problems.append(('malformed entry arc', arc))
+            elif c not in courierGroups[g][0]:
+                problems.append(('entry arc for a courier not in its group', arc))
+        else:
+            if c != 0:
+                problems.append(('main or exit arc for a single courier', arc))
+            if any(orderData[order][3] != restaurant for order in sequence):
+                problems.append(('leaves from the wrong restaurant', arc))
+            if latestLeavingTime > courierGroups[g][1]:
+                problems.append(('leaves after the group\'s off time', arc))
+            if earliestLeavingTime < max(orderData[order][4] for order in sequence):
+                problems.append(('leaves before its orders are ready', arc))
+    return problems
+
+def TimedArcsOf(ns):
+    # Every timed arc is indexed by its group, and lowMemoryMode keeps them nowhere else
+    return set(arc for g in ns['arcsByCourier'] for arc in ns['arcsByCourier'][g])
+
+def CheckNodeCoverage(ns):
+    """
+    Every timed arc goes forwards in time between nodes in the model, and
+    leaves within its untimed arc's window
+    """
+    problems = []
+    nodesInModel, untimedArcData = ns['nodesInModel'], ns['untimedArcData']
+    for arc in TimedArcsOf(ns):
+        ((g, c), r1, t1, s, r2, t2) = arc
+        if (g, r1, t1) not in nodesInModel or (g, r2, t2) not in nodesInModel:
+            problems.append(('timed arc between nodes not in the model', arc))
+        if t1 > t2:
+            problems.append(('timed arc going backwards in time', arc))
+        if s != () and t1 > untimedArcData[(g, c), s, r2][2]:
+            problems.append(('timed arc leaves after its latest leaving time', arc))
+    return problems
+
+def CheckCoverage(ns):
+    # Every order and courier (or courier class) has arcs, and so does every untimed arc
+    problems = []
+    for order in ns['orderData']:
+        if len(ns['arcsByOrder'][order]) == 0:
+            problems.append(('no timed arcs deliver order', order))
+    for courier in ns['outArcsByCourier']:
+        if len(ns['outArcsByCourier'][courier]) == 0:
+            problems.append(('no entry arcs for courier', courier))
+    for untimedArc in ns['arcsByUntimedArc']:
+        if len(ns['arcsByUntimedArc'][untimedArc]) == 0:
+            problems.append(('no timed arcs for untimed arc', untimedArc))
+    return problems
+
+stageChecks = [
+    (CheckBundleTiming, ['sequenceData']),
+    (CheckPairDominance, ['sequenceData', 'sequenceNextRestaurantData']),
+    (CheckUntimedArcWindows, ['untimedArcData']),
+    (CheckNodeCoverage, ['nodesInModel', 'arcsByCourier']),
+    (CheckCoverage, ['arcsByOrder', 'outArcsByCourier'])
+]
+
+def ValidateStages(ns, verbose=True):
+    """
+    Run every check that the script's globals have the data for
+    Returns {check name: [problems]}
+    """
+    problemsByCheck = {}
+    for (check, neededData) in stageChecks:
+        if all(name in ns for name in neededData):
+            problemsByCheck[check.__name__] = check(ns)
+            if verbose:
+                problems = problemsByCheck[check.__name__]
+                print(check.__name__ + ': ' + str(len(problems)) + ' problems ' + str(problems[:maxProblemsShown]))
+    return problemsByCheck
+
+# ============================================================================
+# Running the script and comparing runs
+# ============================================================================
+
+def WriteRandomInstance(directory, seed, restaurantCount=6, orderCount=40, courierCount=8):
+    # Write a small instance in the same format as the Grubhub instances
+    random.seed(seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'restaurants.txt'), 'w') as file:
+        file.write('restaurant\tx\ty\n')
+        for r in range(1, restaurantCount + 1):
+            file.write('r%d\t%d\t%d\n' % (r, random.randint(0, 8000), random.randint(0, 8000)))
+    with open(os.path.join(directory, 'orders.txt'), 'w') as file:
+        file.write('order\tx\ty\tplacement_time\trestaurant\tready_time\n')
+        for o in range(1, orderCount + 1):
+            placementTime = random.randint(0, 400)
+            file.write('o%d\t%d\t%d\t%d\tr%d\t%d\n' % (o, random.randint(0, 8000), random.randint(0, 8000), placementTime,
+                                                    random.randint(1, restaurantCount), placementTime + random.randint(5, 20)))
+    with open(os.path.join(directory, 'couriers.txt'), 'w') as file:
+        file.write('courier\tx\ty\ton_time\toff_time\n')
+        for c in range(1, courierCount + 1):
+            onTime = random.choice([0, 60, 120])
+            file.write('c%d\t%d\t%d\t%d\t%d\n' % (c, random.randint(0, 8000), random.randint(0, 8000), onTime + 1, onTime + random.choice([240, 300])))
+    with open(os.path.join(directory, 'instance_parameters.txt'), 'w') as file:
+        file.write('meters_per_minute\tpickup service minutes\tdropoff service minutes\ttarget click-to-door\tmaximum click-to-door\tpay per order\tguaranteed pay per hour\n')
+        file.write('320\t4\t4\t40\t90\t10\t15\n')
+
+def RunPipeline(instanceDirectory, settings):
+    """
+    Run Optimisation Code.py on the instance up to building the model, with
+    the given settings in place of the ones in the script
+    Returns (the script's globals, its printed output)
+    """
+    scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Optimisation Code.py')
+    with open(scriptPath) as file:
+        source = file.read()
+    source = source[:source.index('\n# Model Setup\n')]
+    settings = dict(settings, fileDirectory=os.path.join(instanceDirectory, ''))
+    for (name, value) in settings.items():
+        source, count = re.subn('^' + name + ' = .*$', name + ' = ' + repr(value), source, count=1, flags=re.M)
+        if count == 0:
+            raise ValueError('No setting ' + name + ' in ' + scriptPath)
+    ns = {'__name__': 'MDRPValidationRun', '__file__': scriptPath}
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        exec(compile(source, scriptPath, 'exec'), ns)
+    return (ns, output.getvalue())
+
+def CompareStages(referenceNs, fastNs):
+    """
+    Compare the bundles, pairs, untimed arcs and timed arcs of two runs, for
+    the stages that both still have
+    Returns {stage: [differences]}
+    """
+    differencesByStage = {}
+    for name in ['sequenceData', 'sequenceNextRestaurantData', 'untimedArcData']:
+        if name in referenceNs and name in fastNs:
+            reference, fast = referenceNs[name], fastNs[name]
+            differences = [('missing', key) for key in reference if key not in fast]
+            differences += [('extra', key) for key in fast if key not in reference]
+            differences += [('different data', key) for key in reference if key in fast and reference[key] != fast[key]]
+            differencesByStage[name] = differences
+    referenceTimedArcs, fastTimedArcs = TimedArcsOf(referenceNs), TimedArcsOf(fastNs)
+    differencesByStage['timedArcs'] = [('missing', arc) for arc in referenceTimedArcs - fastTimedArcs] + [('extra', arc) for arc in fastTimedArcs - referenceTimedArcs]
+    return differencesByStage
+
+def ValidateRandomInstances(instanceCount):
+    # Returns the number of failed checks and comparisons
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(1, instanceCount + 1):
+            instanceDirectory = os.path.join(directory, 'instance' + str(seed))
+            WriteRandomInstance(instanceDirectory, seed)
+            print('Instance ' + str(seed))
+            referenceNs, _ = RunPipeline(instanceDirectory, referenceSettings)
+            for (check, problems) in ValidateStages(referenceNs, verbose=False).items():
+                if len(problems) > 0:
+                    failures += 1
+                    print('    ' + check + ' failed: ' + str(problems[:maxProblemsShown]))
+            for settings in fastEngineSettings:
+                fastNs, _ = RunPipeline(instanceDirectory, dict(referenceSettings, **settings))
+                for (stage, differences) in CompareStages(referenceNs, fastNs).items():
+                    if len(differences) > 0:
+                        failures += 1
+                        print('    ' + str(settings) + ' ' + stage + ' differs: ' + str(differences[:maxProblemsShown]))
+    print(str(failures) + ' failures')
+    return failures
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        randomInstanceCount = int(sys.argv[1])
+    sys.exit(1 if ValidateRandomInstances(randomInstanceCount) > 0 else 0)
@@ -30,9 +30,17 @@ Created on Thu Aug  6 15:43:43 2020
 
 import math
 from collections import defaultdict
+import heapq
 import itertools
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import sys
 from time import time
-from gurobipy import Model, quicksum, GRB
+from gurobipy import Model, quicksum, GRB, Column, LinExpr, Env
+from MDRPSolver import SetupCallback, Callback, ExportModel, ExportFirstRoundLP, ApplyTunedParameters, StartTelemetry, StopTelemetry
 import random
 from operator import lt, gt
 
@@ -57,7 +65,37 @@ globalNodeIntervals = True
 addValidInequalityConstraints = True
 addVIRecursively = True
 limitBundlesToSizeOne = False
+maxBundleSize = None # most orders in a bundle, None for no limit
+bundleLabelBudget = None # most bundles kept per restaurant, None for no limit
+labelsPerOrderSetAndLastOrder = None # most non-dominated bundles kept per (order set, last order), None for no limit
+solutionFile = None # e.g. 'Solution_' + grubhubInstance + '.json', to write the routes of the final solution
 considerObjective = True
+rollingHorizon = False
+rollingHorizonWindowLength = 60 # minutes of order ready times committed per window
+rollingHorizonOverlap = 30 # minutes of look-ahead past the end of each window
+rollingHorizonStateFile = 'RollingHorizon_' + grubhubInstance + '.json'
+onlineMode = False
+onlineStartTime = 120 # orders placed after this time arrive one at a time after the first solve
+onlineLatencyBudget = 5 # seconds allowed for each re-solve
+decomposeByCourierGroup = False
+lagrangianIterations = 30
+lagrangianProcesses = None # None uses every core
+lagrangianSubproblemTimeLimit = 30 # seconds per group subproblem solve, so one hard group can't stall an iteration
+routeColumnGeneration = False
+routeColumnsPerCourier = 5 # most negative reduced cost routes added per courier in each pricing round
+routeLabelsPerArc = 20 # labels kept at each untimed arc while pricing, None for exact pricing (the last round is always exact)
+lazyArcGeneration = False
+useSpatialIndex = False
+spatialIndexCellSize = 2000 # metres
+exportModel = False
+exportDirectory = 'ExportedModels/'
+tunedParametersFile = 'TunedParameters.json' # written by Tune Solver Parameters.py, used if it exists
+telemetryFile = None # e.g. 'Telemetry_' + grubhubInstance + '.tsv', to log the progress of the final solve
+lowMemoryMode = False
+aggregateCourierClasses = False
+courierClassTolerance = 2 # minutes of travel between the starting locations of couriers in the same class
+memoryBudget = 64 # GB, peak memory is reported against this in lowMemoryMode
+validateStages = False # check the invariants of the bundles, pairs, untimed arcs and timed arcs before building the model
 
 def WithoutLetters(string):
     return string.translate({ord(i): None for i in 'abcdefghijklmnopqrstuvwxyz'})
@@ -82,6 +120,34 @@ print(str(len(restaurantData)) + ' restaurants')
 
 def GiveMeAStatusUpdate(label, collectionToDisplayLengthOf):
     print(str(len(collectionToDisplayLengthOf)) + ' ' + label + ' ' + str(time() - programStartTime))
+    if lowMemoryMode:
+        ReportMemory()
+
+def ReportMemory():
+    # Peak memory used so far, which is in kilobytes on Linux and bytes on macOS
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+    if sys.platform == 'darwin':
+        peakMemory /= 1024
+    print('    Peak memory %.2f GB of %.2f GB budget' % (peakMemory, memoryBudget))
+    if peakMemory > memoryBudget:
+        print('Error: peak memory is over budget!')
+
+# Low memory mode frees each stage's inputs once they have been used, streams
+# timed arcs straight into their indexes, and keeps only what the callback
+# and the solution summary need once the model is built
+if lowMemoryMode and (onlineMode or lazyArcGeneration):
+    # These keep adding to the model, so need every stage's data
+    print('Error: lowMemoryMode can\'t be used with onlineMode or lazyArcGeneration!')
+    sys.exit()
+
+if decomposeByCourierGroup and 'fork' not in multiprocessing.get_all_start_methods():
+    # The subproblem workers are forked, so they get the arcs without the script running again
+    print('Error: decomposeByCourierGroup needs the fork start method, which isn\'t available on this platform!')
+    sys.exit()
+if decomposeByCourierGroup and lazyArcGeneration:
+    # The subproblem workers are started before any arcs are added lazily
+    print('Error: decomposeByCourierGroup can\'t be used with lazyArcGeneration!')
+    sys.exit()
 
 with open(fileDirectory + 'instance_parameters.txt') as instanceParameters:
     instanceParameters.readline().strip()
@@ -115,7 +181,69 @@ if orderProportion < 1.0:
     print('Removed restaurants ' + str(restaurantsRemoved))
     print('Now at ' + str(len(orderData)) + ' orders, down from ' + str(totalOrderCount))
     print()
-        
+
+# Rolling horizon
+# The day is split into windows of rollingHorizonWindowLength minutes. Each run
+# of the program solves a single window, considering only the orders that are
+# ready before the end of the window plus the overlap, and that weren't
+# delivered or missed in a previous window. Couriers start from wherever the previous
+# window left them, at the time they became free. Once solved, the decisions
+# made before the end of the window are fixed, the state is saved to the
+# rollingHorizonStateFile, and the program restarts itself on the next window,
+# so that memory use is bounded by the size of a window rather than the day.
+# Each window pays couriers their guaranteed pay for the rest of their shift,
+# from when they become available again, so the guarantee is counted again in
+# every window a courier is in. The objectives of the windows are each
+# window's own cost, and can't be added up to give the cost of the day.
+def AdvanceRollingHorizon(deliveredOrders, missedOrders, courierStates):
+    nextState = {'windowStart': windowEnd, 'deliveredOrders': deliveredOrders, 'missedOrders': missedOrders, 'courierStates': courierStates}
+    with open(rollingHorizonStateFile, 'w') as stateFile:
+        json.dump(nextState, stateFile)
+    print('Window ' + str(windowStart) + '-' + str(windowEnd) + ' complete, ' + str(len(deliveredOrders)) + ' orders delivered and ' + str(len(missedOrders)) + ' missed so far')
+    if windowEnd <= lastReadyTime:
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable, sys.argv[0], 'continue'])
+    print('Rolling horizon complete')
+
+if rollingHorizon:
+    if len(sys.argv) > 1:
+        with open(rollingHorizonStateFile) as stateFile:
+            rollingHorizonState = json.load(stateFile)
+    else:
+        rollingHorizonState = {'windowStart': 0, 'deliveredOrders': [], 'missedOrders': [], 'courierStates': {}}
+    windowStart = rollingHorizonState['windowStart']
+    windowEnd = windowStart + rollingHorizonWindowLength
+    lastReadyTime = max(orderData[order][4] for order in orderData)
+    for order in list(orderData):
+        if order in rollingHorizonState['deliveredOrders'] or order in rollingHorizonState['missedOrders'] or orderData[order][4] >= windowEnd + rollingHorizonOverlap:
+            ordersAtRestaurant[orderData[order][3]].remove(order)
+            del orderData[order]
+    for courier in rollingHorizonState['courierStates']:
+        courierData[int(courier)][:3] = rollingHorizonState['courierStates'][courier]
+    for courier in list(courierData):
+        if courierData[courier][2] >= courierData[courier][3]:
+            # Shift is over, courier can't do anything more
+            del courierData[courier]
+    print('Window ' + str(windowStart) + '-' + str(windowEnd) + ': ' + str(len(orderData)) + ' orders, ' + str(len(courierData)) + ' couriers')
+    if len(orderData) == 0 or len(courierData) == 0:
+        courierStates = dict(rollingHorizonState['courierStates'])
+        courierStates.update({str(c): courierData[c][:2] + [max(courierData[c][2], windowEnd)] for c in courierData})
+        AdvanceRollingHorizon(rollingHorizonState['deliveredOrders'], rollingHorizonState['missedOrders'], courierStates)
+        sys.exit()
+
+# Online mode
+# Only the orders placed by onlineStartTime are known when the model is first
+# built. The rest are held back, and are added to the kept model one at a time
+# in the order they are placed, re-optimising after each one.
+pendingOnlineOrders = {}
+if onlineMode:
+    for order in list(orderData):
+        if orderData[order][2] > onlineStartTime:
+            pendingOnlineOrders[order] = orderData[order]
+            ordersAtRestaurant[orderData[order][3]].remove(order)
+            del orderData[order]
+    print(str(len(pendingOnlineOrders)) + ' orders held back for online mode')
+
 courierGroups = {}
 if groupCouriersByOffTime:
     if not groupCouriersByOnTime:
@@ -149,19 +277,107 @@ def TravelTime(loc1, loc2):
     x2, y2 = loc2[0], loc2[1]
     return math.ceil(math.sqrt((x1-x2)**2 + (y1-y2)**2) / travelSpeed)
 
-for order in orderData:
+# Restaurants are bucketed into square grid cells, so that the restaurants
+# within a travel time of a location can be found without checking all of them
+restaurantGrid = defaultdict(list) # (cellX, cellY): [restaurant1, restaurant2, ...]
+restaurantPosition = {} # restaurant: position in restaurantData, to keep results in a fixed order
+for restaurant in restaurantData:
+    restaurantGrid[(restaurantData[restaurant][0] // spatialIndexCellSize, restaurantData[restaurant][1] // spatialIndexCellSize)].append(restaurant)
+    restaurantPosition[restaurant] = len(restaurantPosition)
+restaurantGrid = dict(restaurantGrid)
+
+def ReachableRestaurants(location, maxTravelTime):
+    """
+    Returns the restaurants that can be reached from location within
+    maxTravelTime, in the order of restaurantData. May include a few
+    restaurants that are slightly too far, so callers must still check.
+    Returns every restaurant if useSpatialIndex is off.
+    """
+    if not useSpatialIndex:
+        return restaurantData
+    if maxTravelTime < 0:
+        return []
+    radius = maxTravelTime * travelSpeed
+    x, y = location[0], location[1]
+    reachable = []
+    for cellX in range(int((x - radius) // spatialIndexCellSize), int((x + radius) // spatialIndexCellSize) + 1):
+        for cellY in range(int((y - radius) // spatialIndexCellSize), int((y + radius) // spatialIndexCellSize) + 1):
+            for restaurant in restaurantGrid.get((cellX, cellY), []):
+                if (restaurantData[restaurant][0] - x)**2 + (restaurantData[restaurant][1] - y)**2 <= radius**2:
+                    reachable.append(restaurant)
+    reachable.sort(key=restaurantPosition.get)
+    return reachable
+
+# Couriers in the same group with the same shift, that start within
+# courierClassTolerance minutes of each other, can be swapped for one another.
+# Each class of these couriers is represented by its first courier, which is
+# the only one of the class left in courierGroups, and can be used as many
+# times as there are couriers in the class.
+courierClasses = {courier: [courier] for courier in courierData} # representative: [courier1, courier2, ...]
+if aggregateCourierClasses:
+    if onlineMode or routeColumnGeneration:
+        # These treat each courier separately
+        print('Error: aggregateCourierClasses can\'t be used with onlineMode or routeColumnGeneration!')
+        sys.exit()
+    courierClasses = {}
+    for group in courierGroups:
+        representatives = []
+        for courier in courierGroups[group][0]:
+            for representative in representatives:
+                if courierData[representative][2:4] == courierData[courier][2:4] and TravelTime(courierData[representative], courierData[courier]) <= courierClassTolerance:
+                    courierClasses[representative].append(courier)
+                    break
+            else:
+                representatives.append(courier)
+                courierClasses[courier] = [courier]
+        courierGroups[group][0] = representatives
+    GiveMeAStatusUpdate('courier classes', courierClasses)
+courierMultiplicity = {courier: len(courierClasses[courier]) for courier in courierClasses}
+
+def CommuteTime(courier, restaurant):
+    # Time for the courier (or every courier in its class) to get from home to the restaurant and pick up
+    return max(TravelTime(courierData[member], restaurantData[restaurant]) for member in courierClasses.get(courier, [courier])) + pickupServiceTime / 2
+
+def RestaurantsReachableAfterSequence(sequence):
+    # An order at the next restaurant has to leave before the end of the day
+    finishTime = sequenceData[sequence][1] + sequenceData[sequence][3]
+    return ReachableRestaurants(orderData[sequence[-1]], globalOffTime - finishTime - (dropoffServiceTime + pickupServiceTime) / 2)
+
+def RestaurantsReachableByCourier(group, courier):
+    # The courier has to arrive at the restaurant before its group's off time
+    return ReachableRestaurants(courierData[courier], courierGroups[group][1] - courierData[courier][2] - pickupServiceTime / 2)
+
+def CompleteOrderData(order):
+    # Add latestLeavingTime, maxClickToDoorArrivalTime and timeToDelivery to the order's data
     maxClickToDoorArrivalTime = orderData[order][2] + maxClickToDoor
     travelTime = (pickupServiceTime + dropoffServiceTime) / 2 + TravelTime(restaurantData[orderData[order][3]], orderData[order])
     orderData[order].append(min(maxClickToDoorArrivalTime - travelTime, globalOffTime))
     orderData[order].append(maxClickToDoorArrivalTime)
     orderData[order].append(travelTime)
 
+for order in orderData:
+    CompleteOrderData(order)
+
+if rollingHorizon:
+    # Orders left over from previous windows that can no longer be picked up
+    missedOrders = [order for order in orderData if orderData[order][5] < windowStart]
+    for order in missedOrders:
+        ordersAtRestaurant[orderData[order][3]].remove(order)
+        del orderData[order]
+    if len(missedOrders) > 0:
+        print('Missed orders ' + str(missedOrders))
+
 def CompareOneIndex(op, dictionary, key1, key2, index):
     return op(dictionary[key1][index], dictionary[key2][index])
 
 def CompareTwoIndices(op1, op2, dictionary, key1, key2, index1, index2):
     return CompareOneIndex(op1, dictionary, key1, key2, index1) and CompareOneIndex(op2, dictionary, key1, key2, index2)
 
+# Bundles removed by each cap. maxBundleSize stops bundles being generated at
+# all, so for it this is the number of bundles at the largest size that
+# weren't extended any further.
+bundlesRemovedByCap = {'maxBundleSize': 0, 'bundleLabelBudget': 0, 'labelsPerOrderSetAndLastOrder': 0}
+
 def FindAllOrderBundles():
     """
     Calculate & dominate order sequences
@@ -183,50 +399,105 @@ def FindAllOrderBundles():
     """
     BundleDataDictionary = {}
     for restaurant in restaurantData:
-        newBundles = []
-        
-        # create a new bundle for every order at the restaurant
-        for order in ordersAtRestaurant[restaurant]:
-            (earliestLeavingTime, latestLeavingTime, _, travelTime) = orderData[order][4:8]
-            newBundles.append((order,))
-            BundleDataDictionary[(order,)] = [restaurant, earliestLeavingTime, latestLeavingTime, travelTime]
-        
-        if limitBundlesToSizeOne: continue
-        
-        while len(newBundles) > 0:
-            bundlesByOrderSetAndFinalOrder = {}
-            basisBundles = newBundles
-            newBundles = []
-            for bundle in basisBundles:
-                (_, earliestLeavingTime, latestLeavingTime, travelTime) = BundleDataDictionary[bundle]
-                for order in ordersAtRestaurant[restaurant]:
-                    if order not in bundle:
-                        newBundle = bundle + (order,)
-                        newTravelTime = travelTime + TravelTime(orderData[bundle[-1]], orderData[order]) + dropoffServiceTime
-                        newLatestLeavingTime = min(latestLeavingTime, orderData[order][6] - newTravelTime)
-                        newEarliestLeavingTime = max(earliestLeavingTime, orderData[order][4])
-                        if newLatestLeavingTime >= newEarliestLeavingTime:
-                            # bundle is valid, dominate
-                            orderSet = frozenset(newBundle)
-                            lastOrder = newBundle[-1]
-                            BundleDataDictionary[newBundle] = [restaurant, newEarliestLeavingTime, newLatestLeavingTime, newTravelTime]
-                            if (orderSet, lastOrder) not in bundlesByOrderSetAndFinalOrder:
-                                newBundles.append(newBundle)
-                                bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)] = [newBundle]
-                            else:
-                                oldBundles = bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)]
-                                (dominated, dominatedBundles) = Dominate(newBundle, oldBundles, BundleDataDictionary)
-                                if dominated:
-                                    del BundleDataDictionary[newBundle]
-                                else:
-                                    bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)].append(newBundle)
-                                    newBundles.append(newBundle)
-                                    for dominatedBundle in dominatedBundles:
-                                        del BundleDataDictionary[dominatedBundle]
-                                        newBundles.remove(dominatedBundle)
-                                        bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)].remove(dominatedBundle)
+        FindOrderBundlesAtRestaurant(restaurant, BundleDataDictionary)
+    if bundlesRemovedByCap['maxBundleSize'] > 0:
+        print(str(bundlesRemovedByCap['maxBundleSize']) + ' bundles at the largest size allowed by maxBundleSize (or limitBundlesToSizeOne) not extended further')
+    for cap in ['bundleLabelBudget', 'labelsPerOrderSetAndLastOrder']:
+        if bundlesRemovedByCap[cap] > 0:
+            print(str(bundlesRemovedByCap[cap]) + ' bundles removed by ' + cap)
     return BundleDataDictionary
 
+def FindOrderBundlesAtRestaurant(restaurant, BundleDataDictionary):
+    """
+    Calculate & dominate the order sequences for a single restaurant, adding
+    them to BundleDataDictionary
+    """
+    newBundles = []
+    
+    # create a new bundle for every order at the restaurant
+    for order in ordersAtRestaurant[restaurant]:
+        (earliestLeavingTime, latestLeavingTime, _, travelTime) = orderData[order][4:8]
+        newBundles.append((order,))
+        BundleDataDictionary[(order,)] = [restaurant, earliestLeavingTime, latestLeavingTime, travelTime]
+    
+    if lazyArcGeneration: return
+    if limitBundlesToSizeOne or maxBundleSize == 1:
+        bundlesRemovedByCap['maxBundleSize'] += len(newBundles)
+        return
+    
+    bundleSize = 1
+    bundlesAtRestaurant = len(newBundles)
+    while len(newBundles) > 0:
+        if maxBundleSize is not None and bundleSize >= maxBundleSize:
+            bundlesRemovedByCap['maxBundleSize'] += len(newBundles)
+            break
+        newBundles = ExtendBundlesByOneOrder(newBundles, restaurant, BundleDataDictionary)
+        bundleSize += 1
+        if bundleLabelBudget is not None and bundlesAtRestaurant + len(newBundles) > bundleLabelBudget:
+            # Keep the best of this size that fit in the budget, and stop
+            newBundles.sort(key=lambda bundle: BundleCost(bundle, BundleDataDictionary))
+            for bundle in newBundles[max(bundleLabelBudget - bundlesAtRestaurant, 0):]:
+                del BundleDataDictionary[bundle]
+            bundlesRemovedByCap['bundleLabelBudget'] += len(newBundles) - max(bundleLabelBudget - bundlesAtRestaurant, 0)
+            break
+        bundlesAtRestaurant += len(newBundles)
+
+def BundleCost(bundle, BundleDataDictionary):
+    # Travel time less slack. Bundles with a lower cost are kept first when over a cap
+    (_, earliestLeavingTime, latestLeavingTime, travelTime) = BundleDataDictionary[bundle]
+    return travelTime - (latestLeavingTime - earliestLeavingTime)
+
+def ExtendBundlesByOneOrder(basisBundles, restaurant, BundleDataDictionary):
+    """
+    Create & dominate every bundle made by adding another order from the
+    restaurant to the end of one of the basis bundles, adding them to
+    BundleDataDictionary. Returns the new bundles.
+    """
+    bundlesByOrderSetAndFinalOrder = {}
+    newBundles = []
+    for bundle in basisBundles:
+        (_, earliestLeavingTime, latestLeavingTime, travelTime) = BundleDataDictionary[bundle]
+        for order in ordersAtRestaurant[restaurant]:
+            if order not in bundle:
+                newBundle = bundle + (order,)
+                newTravelTime = travelTime + TravelTime(orderData[bundle[-1]], orderData[order]) + dropoffServiceTime
+                newLatestLeavingTime = min(latestLeavingTime, orderData[order][6] - newTravelTime)
+                newEarliestLeavingTime = max(earliestLeavingTime, orderData[order][4])
+                if newLatestLeavingTime >= newEarliestLeavingTime:
+                    # bundle is valid, dominate
+                    orderSet = frozenset(newBundle)
+                    lastOrder = newBundle[-1]
+                    BundleDataDictionary[newBundle] = [restaurant, newEarliestLeavingTime, newLatestLeavingTime, newTravelTime]
+                    if (orderSet, lastOrder) not in bundlesByOrderSetAndFinalOrder:
+                        newBundles.append(newBundle)
+                        bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)] = [newBundle]
+                    else:
+                        oldBundles = bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)]
+                        (dominated, dominatedBundles) = Dominate(newBundle, oldBundles, BundleDataDictionary)
+                        if dominated:
+                            del BundleDataDictionary[newBundle]
+                        else:
+                            bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)].append(newBundle)
+                            newBundles.append(newBundle)
+                            for dominatedBundle in dominatedBundles:
+                                del BundleDataDictionary[dominatedBundle]
+                                newBundles.remove(dominatedBundle)
+                                bundlesByOrderSetAndFinalOrder[(orderSet, lastOrder)].remove(dominatedBundle)
+    
+    if labelsPerOrderSetAndLastOrder is not None:
+        # Keep only the best of the non-dominated bundles with each order set and last order
+        removedBundles = set()
+        for sameBundles in bundlesByOrderSetAndFinalOrder.values():
+            if len(sameBundles) > labelsPerOrderSetAndLastOrder:
+                sameBundles.sort(key=lambda bundle: BundleCost(bundle, BundleDataDictionary))
+                for bundle in sameBundles[labelsPerOrderSetAndLastOrder:]:
+                    del BundleDataDictionary[bundle]
+                    removedBundles.add(bundle)
+        if len(removedBundles) > 0:
+            newBundles = [bundle for bundle in newBundles if bundle not in removedBundles]
+            bundlesRemovedByCap['labelsPerOrderSetAndLastOrder'] += len(removedBundles)
+    return newBundles
+
 def Dominate(item, comparisonList, dataDictionary):
     """
     item can be a bundle or a bundle-restaurant pair
@@ -302,22 +573,34 @@ def CheckDominationPairs(sequenceToCheck, nextRestaurant):
                 dominatedSequences.append(sequence)
     return dominatedSequences
 
-groupedPairs = defaultdict(list) # (frozenset(sequence), nextRestaurant): [sequence1, sequence2, sequence3, ...]
-for sequence in sequenceData:
+def FindPairsForSequence(sequence, restaurants):
+    """
+    Create & dominate the sequence-next restaurant pairs between the sequence
+    and each of the restaurants. Returns the pairs created, some of which may
+    have since been dominated.
+    """
+    createdPairs = []
     finishTime = sequenceData[sequence][1] + sequenceData[sequence][3]
-    for restaurant in restaurantData:
+    for restaurant in restaurants:
         arrivalAtRestaurant = finishTime + TravelTime(orderData[sequence[-1]], restaurantData[restaurant]) + (dropoffServiceTime + pickupServiceTime) / 2
         for order in ordersAtRestaurant[restaurant]:
             if order not in sequence:
                 if orderData[order][5] > arrivalAtRestaurant:
                     travelTime = sequenceData[sequence][3] + TravelTime(orderData[sequence[-1]], restaurantData[restaurant]) + (dropoffServiceTime + pickupServiceTime) / 2
                     sequenceNextRestaurantData[(sequence, restaurant)] = sequenceData[sequence][:3] + [travelTime]
-                    groupedPairs[(frozenset(sequence), restaurant)].append(sequence)
-                    dominatedSequences = CheckDominationPairs(sequence, restaurant)
-                    for dominatedSequence in dominatedSequences:
-                        del sequenceNextRestaurantData[(dominatedSequence, restaurant)]
-                        groupedPairs[(frozenset(sequence), restaurant)].remove(dominatedSequence)
+                    groupedPairs.setdefault((frozenset(sequence), restaurant), []).append(sequence)
+                    if len(sequence) > 1: # a single order is the only sequence of its order set, so there is nothing to dominate
+                        dominatedSequences = CheckDominationPairs(sequence, restaurant)
+                        for dominatedSequence in dominatedSequences:
+                            del sequenceNextRestaurantData[(dominatedSequence, restaurant)]
+                            groupedPairs[(frozenset(sequence), restaurant)].remove(dominatedSequence)
+                    createdPairs.append((sequence, restaurant))
                     break
+    return createdPairs
+
+groupedPairs = defaultdict(list) # (frozenset(sequence), nextRestaurant): [sequence1, sequence2, sequence3, ...]
+for sequence in sequenceData:
+    FindPairsForSequence(sequence, RestaurantsReachableAfterSequence(sequence))
 groupedPairs = dict(groupedPairs)
 GiveMeAStatusUpdate('post-domination pairs', sequenceNextRestaurantData)
 
@@ -335,42 +618,54 @@ untimedArcs = set()
 # 6. the earliest leaving time plus the travel time is before the group's off time (less refined version of 4)
 # The courier must leave in time to deliver its orders, as well as in time to
 # deliver an order at the next restaurant.
-for sequence, nextRestaurant in sequenceNextRestaurantData:
+def MainUntimedArcData(sequence, nextRestaurant, group):
+    """
+    Returns the data for the main untimed arc ((group, 0), sequence, nextRestaurant),
+    or None if the arc isn't valid for the group
+    """
     restaurant, earliestLeavingTime, latestLeavingTime, travelTime = sequenceNextRestaurantData[sequence, nextRestaurant]
+    offTime = courierGroups[group][1]
+    if offTime >= earliestLeavingTime + travelTime: # check conditions 1, 6
+        foundValidCourier = False
+        bestArrivalTime = globalOffTime
+        for courier in courierGroups[group][0]:
+            commute = CommuteTime(courier, restaurant)
+            arrivalAtDepartureRestaurant = courierData[courier][2] + commute
+            if arrivalAtDepartureRestaurant <= min(latestLeavingTime, offTime): # check conditions 2 and 3
+                foundValidCourier = True
+                if arrivalAtDepartureRestaurant < bestArrivalTime:
+                    bestArrivalTime = arrivalAtDepartureRestaurant
+        if foundValidCourier:
+            earliestDepartureFromDepartureRestaurant = max(bestArrivalTime, earliestLeavingTime) # can't leave before arrive
+            if earliestDepartureFromDepartureRestaurant > latestLeavingTime:
+                print('Main untimed arc error 1!', str(group), str(sequence), str(nextRestaurant))
+            arrivalAtNextRestaurant = earliestDepartureFromDepartureRestaurant + travelTime
+            if arrivalAtNextRestaurant <= offTime: # check condition 4
+                foundValidOrder = False
+                bestOrderLatestLeavingTime = 0
+                for order in ordersAtRestaurant[nextRestaurant]:
+                    if order not in sequence:
+                        if orderData[order][4] <= offTime and orderData[order][5] >= arrivalAtNextRestaurant:
+                            foundValidOrder = True
+                            if orderData[order][5] > bestOrderLatestLeavingTime:
+                                bestOrderLatestLeavingTime = orderData[order][5]
+                if foundValidOrder: # check condition 5
+                    latestArrivalAtNextRestaurant = min(bestOrderLatestLeavingTime, offTime)
+                    latestDepartureAtDepartureRestaurant = min(latestArrivalAtNextRestaurant - travelTime, latestLeavingTime)
+                    if latestDepartureAtDepartureRestaurant < earliestDepartureFromDepartureRestaurant:
+                        print('Main untimed arc error 2!', str(group), str(sequence), str(nextRestaurant))
+                    return [restaurant, earliestDepartureFromDepartureRestaurant, latestDepartureAtDepartureRestaurant, travelTime]
+    return None
+
+for sequence, nextRestaurant in sequenceNextRestaurantData:
     for group in courierGroups:
-        offTime = courierGroups[group][1]
-        if offTime >= earliestLeavingTime + travelTime: # check conditions 1, 6
-            foundValidCourier = False
-            bestArrivalTime = globalOffTime
-            for courier in courierGroups[group][0]:
-                commute = TravelTime(courierData[courier], restaurantData[restaurant]) + pickupServiceTime / 2
-                arrivalAtDepartureRestaurant = courierData[courier][2] + commute
-                if arrivalAtDepartureRestaurant <= min(latestLeavingTime, offTime): # check conditions 2 and 3
-                    foundValidCourier = True
-                    if arrivalAtDepartureRestaurant < bestArrivalTime:
-                        bestArrivalTime = arrivalAtDepartureRestaurant
-            if foundValidCourier:
-                earliestDepartureFromDepartureRestaurant = max(bestArrivalTime, earliestLeavingTime) # can't leave before arrive
-                if earliestDepartureFromDepartureRestaurant > latestLeavingTime:
-                    print('Main untimed arc error 1!', str(group), str(sequence), str(nextRestaurant))
-                arrivalAtNextRestaurant = earliestDepartureFromDepartureRestaurant + travelTime
-                if arrivalAtNextRestaurant <= offTime: # check condition 4
-                    foundValidOrder = False
-                    bestOrderLatestLeavingTime = 0
-                    for order in ordersAtRestaurant[nextRestaurant]:
-                        if order not in sequence:
-                            if orderData[order][4] <= offTime and orderData[order][5] >= arrivalAtNextRestaurant:
-                                foundValidOrder = True
-                                if orderData[order][5] > bestOrderLatestLeavingTime:
-                                    bestOrderLatestLeavingTime = orderData[order][5]
-                    if foundValidOrder: # check condition 5
-                        latestArrivalAtNextRestaurant = min(bestOrderLatestLeavingTime, offTime)
-                        latestDepartureAtDepartureRestaurant = min(latestArrivalAtNextRestaurant - travelTime, latestLeavingTime)
-                        if latestDepartureAtDepartureRestaurant < earliestDepartureFromDepartureRestaurant:
-                            print('Main untimed arc error 2!', str(group), str(sequence), str(nextRestaurant))
-                        untimedArcs.add(((group, 0), sequence, nextRestaurant))
-                        untimedArcData[((group, 0), sequence, nextRestaurant)] = [restaurant, earliestDepartureFromDepartureRestaurant, latestDepartureAtDepartureRestaurant, travelTime]
+        arcData = MainUntimedArcData(sequence, nextRestaurant, group)
+        if arcData is not None:
+            untimedArcs.add(((group, 0), sequence, nextRestaurant))
+            untimedArcData[((group, 0), sequence, nextRestaurant)] = arcData
 GiveMeAStatusUpdate('main untimedArcs', untimedArcs)
+if lowMemoryMode:
+    del sequenceNextRestaurantData, groupedPairs
 
 # Exit untimedArcs
 # Create sequence-courier (off time) pairs, with nextRestaurant = 0
@@ -379,26 +674,38 @@ GiveMeAStatusUpdate('main untimedArcs', untimedArcs)
 # - Earliest leaving time must be before the group's off time
 # - At least one courier can arrive at the restaurant before off time
 # - Out of those couriers, at least one must arrive before latest leaving time
+def ExitUntimedArcData(sequence, group):
+    """
+    Returns the data for the exit untimed arc ((group, 0), sequence, 0), or
+    None if the arc isn't valid for the group
+    """
+    restaurant, earliestLeavingTime, latestLeavingTime, totalTravelTime = sequenceData[sequence]
+    offTime = courierGroups[group][1]
+    if offTime >= earliestLeavingTime: # sequence must be deliverable in courier's shift
+        foundValidCourier = False
+        bestArrivalTime = globalOffTime
+        for courier in courierGroups[group][0]:
+            commute = CommuteTime(courier, restaurant)
+            arrivalTime = courierData[courier][2] + commute
+            if arrivalTime <= min(offTime, latestLeavingTime): # courier must arrive at restaurant in-shift, and in time to pick up and deliver order
+                foundValidCourier = True
+                bestArrivalTime = min(arrivalTime, bestArrivalTime)
+        if foundValidCourier: # only add arc if valid courier found, add data for best courier found
+            return [restaurant, max(earliestLeavingTime, bestArrivalTime), min(latestLeavingTime, offTime), totalTravelTime]
+    return None
+
 exitUntimedArcsByCourierRestaurant = defaultdict(list)
 for sequence in sequenceData:
-    restaurant, earliestLeavingTime, latestLeavingTime, totalTravelTime = sequenceData[sequence]
     for group in courierGroups:
-        offTime = courierGroups[group][1]
-        if offTime >= earliestLeavingTime: # sequence must be deliverable in courier's shift
-            foundValidCourier = False
-            bestArrivalTime = globalOffTime
-            for courier in courierGroups[group][0]:
-                commute = TravelTime(courierData[courier], restaurantData[restaurant]) + pickupServiceTime / 2
-                arrivalTime = courierData[courier][2] + commute
-                if arrivalTime <= min(offTime, latestLeavingTime): # courier must arrive at restaurant in-shift, and in time to pick up and deliver order
-                    foundValidCourier = True
-                    bestArrivalTime = min(arrivalTime, bestArrivalTime)
-            if foundValidCourier: # only add arc if valid courier found, add data for best courier found
-                untimedArcs.add(((group, 0), sequence, 0))
-                untimedArcData[((group, 0), sequence, 0)] = [restaurant, max(earliestLeavingTime, bestArrivalTime), min(latestLeavingTime, offTime), totalTravelTime]
-                exitUntimedArcsByCourierRestaurant[(group, restaurant)].append(((group, 0), sequence, 0))
+        arcData = ExitUntimedArcData(sequence, group)
+        if arcData is not None:
+            untimedArcs.add(((group, 0), sequence, 0))
+            untimedArcData[((group, 0), sequence, 0)] = arcData
+            exitUntimedArcsByCourierRestaurant[(group, arcData[0])].append(((group, 0), sequence, 0))
 exitUntimedArcsByCourierRestaurant = dict(exitUntimedArcsByCourierRestaurant)
 GiveMeAStatusUpdate('main + exit untimedArcs', untimedArcs)
+if lowMemoryMode:
+    del sequenceData, sequencesByRestaurantThenOrderSet
 
 # Entry untimed arcs
 # An entry untimed arc is of the form ((courierGroup, courier), (), restaurant)
@@ -409,45 +716,59 @@ GiveMeAStatusUpdate('main + exit untimedArcs', untimedArcs)
 #   - The order's ready time is before the courier's off time
 #   - The order's latest departure time is after the courier's arrival time
 # Assume for calculations that the courier will travel directly to the restaurant, from home, at the beginning of the shift
+def EntryUntimedArcData(group, courier, restaurant):
+    """
+    Returns the data for the entry untimed arc ((group, courier), (), restaurant),
+    or None if the courier can't usefully start at the restaurant
+    """
+    offTime = courierGroups[group][1]
+    courierShiftStartTime = courierData[courier][2]
+    commuteToRestaurant = CommuteTime(courier, restaurant)
+    earliestArrivalAtRestaurant = courierShiftStartTime + commuteToRestaurant
+    if earliestArrivalAtRestaurant <= offTime:
+        # Checking that the courier can arrive before its off time
+        latestAllowedCourierArrival = 0
+        for order in ordersAtRestaurant[restaurant]:
+            # Loop through orders, to check if courier-restaurant pair is valid
+            if orderData[order][4] <= offTime and orderData[order][5] >= earliestArrivalAtRestaurant:
+                # This order is deliverable by the courier
+                if orderData[order][5] > offTime:
+                    # If this is true, the courier has no time restriction on when it arrives at the restaurant
+                    latestAllowedCourierArrival = offTime
+                    break
+                latestAllowedCourierArrival = max(latestAllowedCourierArrival, orderData[order][5])
+        if latestAllowedCourierArrival >= earliestArrivalAtRestaurant:
+            if earliestArrivalAtRestaurant <= 0:
+                print('Error! Courier arriving at restaurant before the day starts!', courier, restaurant)
+            # If this is true, then there must have been at least one valid order to bring the latest allowed arrival above zero
+            return [0, courierShiftStartTime, latestAllowedCourierArrival - commuteToRestaurant, commuteToRestaurant]
+    return None
 
 for group in courierGroups:
-    offTime = courierGroups[group][1]
     for courier in courierGroups[group][0]:
-        courierShiftStartTime = courierData[courier][2]
-        for restaurant in restaurantData:
-            # Looping through every courier-restaurant pair
-            commuteToRestaurant = TravelTime(courierData[courier], restaurantData[restaurant]) + pickupServiceTime / 2
-            earliestArrivalAtRestaurant = courierShiftStartTime + commuteToRestaurant
-            if earliestArrivalAtRestaurant <= offTime:
-                # Checking that the courier can arrive before its off time
-                latestAllowedCourierArrival = 0
-                for order in ordersAtRestaurant[restaurant]:
-                    # Loop through orders, to check if courier-restaurant pair is valid
-                    if orderData[order][4] <= offTime and orderData[order][5] >= earliestArrivalAtRestaurant:
-                        # This order is deliverable by the courier
-                        if orderData[order][5] > offTime:
-                            # If this is true, the courier has no time restriction on when it arrives at the restaurant
-                            latestAllowedCourierArrival = offTime
-                            break
-                        latestAllowedCourierArrival = max(latestAllowedCourierArrival, orderData[order][5])
-                if latestAllowedCourierArrival >= earliestArrivalAtRestaurant:
-                    if earliestArrivalAtRestaurant <= 0:
-                        print('Error! Courier arriving at restaurant before the day starts!', courier, restaurant)
-                    # If this is true, then there must have been at least one valid order to bring the latest allowed arrival above zero
-                    untimedArcs.add(((group, courier), (), restaurant))
-                    untimedArcData[((group, courier), (), restaurant)] = [0, courierShiftStartTime, latestAllowedCourierArrival - commuteToRestaurant, commuteToRestaurant]
+        for restaurant in RestaurantsReachableByCourier(group, courier):
+            # Looping through every reachable courier-restaurant pair
+            arcData = EntryUntimedArcData(group, courier, restaurant)
+            if arcData is not None:
+                untimedArcs.add(((group, courier), (), restaurant))
+                untimedArcData[((group, courier), (), restaurant)] = arcData
 GiveMeAStatusUpdate('untimed arcs total', untimedArcs)
 
+def IndexUntimedArc(arc):
+    if arc[1] == ():
+        untimedArcsByCourierRestaurant.setdefault((arc[0][0], 0), []).append(arc)
+    else:
+        untimedArcsByCourierRestaurant.setdefault((arc[0][0], untimedArcData[arc][0]), []).append(arc)
+    untimedArcsByCourierNextRestaurant.setdefault((arc[0][0], arc[2]), []).append(arc)
+
 untimedArcsByCourierRestaurant = defaultdict(list)
 untimedArcsByCourierNextRestaurant = defaultdict(list)
 for arc in untimedArcs:
-    if arc[1] == ():
-        untimedArcsByCourierRestaurant[(arc[0][0], 0)].append(arc)
-    else:
-        untimedArcsByCourierRestaurant[(arc[0][0], untimedArcData[arc][0])].append(arc)
-    untimedArcsByCourierNextRestaurant[(arc[0][0], arc[2])].append(arc)
+    IndexUntimedArc(arc)
 untimedArcsByCourierRestaurant = dict(untimedArcsByCourierRestaurant)
 untimedArcsByCourierNextRestaurant = dict(untimedArcsByCourierNextRestaurant)
+if lowMemoryMode:
+    del untimedArcs
 
 # ============================================================================
 # Calculate predecessors and successors for untimed arcs, and save this
@@ -478,14 +799,222 @@ def CalculateSuccessorsFromUntimedArc(untimedArc):
                 foundSuccessors.append(arc)
     return foundSuccessors
 
-predecessorsForUntimedArc = {arc: [] for arc in untimedArcData}
-successorsForUntimedArc = {arc: [] for arc in untimedArcData}    
+# Only needed for route column generation, and for adding all VIs at once
+if routeColumnGeneration or (addValidInequalityConstraints and not addVIRecursively):
+    predecessorsForUntimedArc = {arc: [] for arc in untimedArcData}
+    successorsForUntimedArc = {arc: [] for arc in untimedArcData}    
+    
+    for arc in untimedArcData:
+        predecessorsForUntimedArc[arc] = CalculatePredecessorsFromUntimedArc(arc)
+        successorsForUntimedArc[arc] = CalculateSuccessorsFromUntimedArc(arc)
+    
+    print('Completed predecessor and successor calculations', time() - programStartTime)
+
+# ============================================================================
+# Column generation over courier routes
+# Rather than enumerating every timed arc, a master problem picks a route for
+# each courier (or none), so that every order is delivered once. A route is a
+# chain of untimed arcs from one of the courier's entry arcs to an exit arc,
+# and is paid as the IPD model pays a courier. The master starts from greedy
+# routes, and new routes are priced with a resource constrained shortest path
+# over successorsForUntimedArc, using the duals of the order and courier
+# constraints. Routes are only added while their reduced cost is negative.
+# Each route follows its own courier's times, so it is always legal and the
+# callback isn't needed. Once no more routes price out, the master is solved
+# as an integer program over the routes generated.
+# ============================================================================
+
+def ShiftPay(courier):
+    return (courierData[courier][3] - courierData[courier][2]) * minPayPerHour / 60
+
+def RouteCost(courier, deliveryCount):
+    if not considerObjective:
+        return 0
+    return max(deliveryCount * payPerDelivery, ShiftPay(courier))
 
-for arc in untimedArcData:
-    predecessorsForUntimedArc[arc] = CalculatePredecessorsFromUntimedArc(arc)
-    successorsForUntimedArc[arc] = CalculateSuccessorsFromUntimedArc(arc)
+def UntimedArcArrivalTime(arc):
+    return untimedArcData[arc][1] + untimedArcData[arc][3]
+
+def AddRouteColumn(courier, route):
+    orders = [o for arc in route for o in arc[1]]
+    constraints = [routeDeliverOrders[o] for o in orders] + [routeLeaveHome[courier]]
+    routeVars[courier, route] = master.addVar(obj=RouteCost(courier, len(orders)), column=Column([1] * len(constraints), constraints))
+
+def GreedyRoute(courier, uncoveredOrders):
+    """
+    Build a route for the courier that only delivers uncovered orders
+    
+    As in SummariseModel, the courier takes whichever arc it can leave on
+    first. Main arcs are only taken if some exit arc can follow them, and the
+    route finishes on the exit arc with the most orders once no main arc can.
+    Entry arcs are tried from the earliest arrival. Returns None if no route
+    can be found.
+    """
+    for entryArc in sorted(entryArcsByCourier[courier], key=UntimedArcArrivalTime):
+        route = [entryArc]
+        currentTime = UntimedArcArrivalTime(entryArc)
+        routeOrders = set()
+        while True:
+            availableOrders = uncoveredOrders - routeOrders
+            bestExitArc = None
+            bestMainArc = None
+            bestDepartureTime = globalOffTime
+            for arc in successorsForUntimedArc[route[-1]]:
+                departureTime = max(currentTime, untimedArcData[arc][1])
+                if departureTime <= untimedArcData[arc][2] and set(arc[1]) <= availableOrders:
+                    if arc[2] == 0:
+                        if bestExitArc is None or len(arc[1]) > len(bestExitArc[1]):
+                            bestExitArc = arc
+                    elif departureTime < bestDepartureTime:
+                        arrivalTime = departureTime + untimedArcData[arc][3]
+                        for nextArc in successorsForUntimedArc[arc]:
+                            if nextArc[2] == 0 and max(arrivalTime, untimedArcData[nextArc][1]) <= untimedArcData[nextArc][2] and set(nextArc[1]) <= availableOrders - set(arc[1]):
+                                bestMainArc = arc
+                                bestDepartureTime = departureTime
+                                break
+            if bestMainArc is not None:
+                route.append(bestMainArc)
+                currentTime = bestDepartureTime + untimedArcData[bestMainArc][3]
+                routeOrders.update(bestMainArc[1])
+            elif bestExitArc is not None:
+                route.append(bestExitArc)
+                return tuple(route)
+            else:
+                break
+    return None
+
+def AddLabelIfNotDominated(newLabel, labels):
+    """
+    A label is [arrivalTime, orders, dualTotal, route, alive]
+    
+    'a' dominates 'b' if:
+        'a' arrives no later; and
+        'a' has delivered a subset of the orders of 'b'; and
+        'a' has collected at least as much from the order duals
+    Returns False if newLabel is dominated, otherwise adds it to labels, and
+    marks the labels that it dominates as dead. If there are more than
+    routeLabelsPerArc labels left, the one with the smallest dual total is
+    dropped, which makes pricing a heuristic.
+    """
+    for label in labels:
+        if label[0] <= newLabel[0] and label[1] <= newLabel[1] and label[2] >= newLabel[2]:
+            return False
+    for label in labels:
+        if newLabel[0] <= label[0] and newLabel[1] <= label[1] and newLabel[2] >= label[2]:
+            label[4] = False
+    labels[:] = [label for label in labels if label[4]]
+    labels.append(newLabel)
+    if routeLabelsPerArc is not None and len(labels) > routeLabelsPerArc:
+        worstLabel = min(labels, key=lambda label: label[2])
+        worstLabel[4] = False
+        labels.remove(worstLabel)
+        return worstLabel is not newLabel
+    return True
+
+def PriceRoutes(courier, orderDuals, courierDual, maxRoutes):
+    """
+    Resource constrained shortest path over the untimed arcs, from the
+    courier's entry arcs to any exit arc. Labels are extended in order of
+    arrival time, and the orders on a route must be distinct.
+    Returns [(reducedCost, route), ...] for the maxRoutes routes with the most
+    negative reduced costs, most negative first.
+    """
+    labelsAtArc = defaultdict(list)
+    labelHeap = []
+    labelCounter = itertools.count()
+    pricedRoutes = []
+    for entryArc in entryArcsByCourier[courier]:
+        label = [UntimedArcArrivalTime(entryArc), frozenset(), 0, (entryArc,), True]
+        heapq.heappush(labelHeap, (label[0], next(labelCounter), label))
+    while len(labelHeap) > 0:
+        _, _, label = heapq.heappop(labelHeap)
+        if not label[4]:
+            continue
+        currentTime, orders, dualTotal, route, _ = label
+        for arc in successorsForUntimedArc[route[-1]]:
+            if orders.isdisjoint(arc[1]):
+                departureTime = max(currentTime, untimedArcData[arc][1])
+                if departureTime <= untimedArcData[arc][2]:
+                    newOrders = orders.union(arc[1])
+                    newDualTotal = dualTotal + sum(orderDuals[o] for o in arc[1])
+                    if arc[2] == 0:
+                        reducedCost = RouteCost(courier, len(newOrders)) - newDualTotal - courierDual
+                        if reducedCost < -0.0001:
+                            # Keep the best maxRoutes routes in a heap, with the least negative on top
+                            if len(pricedRoutes) < maxRoutes:
+                                heapq.heappush(pricedRoutes, (-reducedCost, next(labelCounter), route + (arc,)))
+                            elif -reducedCost > pricedRoutes[0][0]:
+                                heapq.heapreplace(pricedRoutes, (-reducedCost, next(labelCounter), route + (arc,)))
+                    else:
+                        newLabel = [departureTime + untimedArcData[arc][3], newOrders, newDualTotal, route + (arc,), True]
+                        if AddLabelIfNotDominated(newLabel, labelsAtArc[arc]):
+                            heapq.heappush(labelHeap, (newLabel[0], next(labelCounter), newLabel))
+    return [(-negativeReducedCost, route) for (negativeReducedCost, _, route) in sorted(pricedRoutes, reverse=True)]
+
+if routeColumnGeneration:
+    entryArcsByCourier = {c: [] for c in courierData}
+    for arc in untimedArcData:
+        if arc[1] == ():
+            entryArcsByCourier[arc[0][1]].append(arc)
+    
+    master = Model('MDRP routes')
+    master.setParam('OutputFlag', 0)
+    # Artificial variables let the master start without covering every order
+    bigM = sum(ShiftPay(c) for c in courierData) + len(orderData) * payPerDelivery + 1
+    uncoveredOrderVars = {o: master.addVar(obj=bigM) for o in orderData}
+    idleCourierVars = {c: master.addVar(obj=ShiftPay(c) if considerObjective else 0) for c in courierData}
+    routeDeliverOrders = {o: master.addConstr(uncoveredOrderVars[o] == 1) for o in orderData}
+    routeLeaveHome = {c: master.addConstr(idleCourierVars[c] == 1) for c in courierData}
+    routeVars = {} # (courier, route): var
+    
+    uncoveredOrders = set(orderData)
+    for c in sorted(courierData, key=lambda courier: courierData[courier][2]):
+        route = GreedyRoute(c, uncoveredOrders)
+        if route is not None:
+            AddRouteColumn(c, route)
+            uncoveredOrders -= set(o for arc in route for o in arc[1])
+    GiveMeAStatusUpdate('greedy routes', routeVars)
+    
+    print('Round, routes added, LP objective, time')
+    pricingRound = 0
+    while True:
+        master.optimize()
+        orderDuals = {o: routeDeliverOrders[o].Pi for o in orderData}
+        routesAdded = 0
+        for c in courierData:
+            for reducedCost, route in PriceRoutes(c, orderDuals, routeLeaveHome[c].Pi, routeColumnsPerCourier):
+                AddRouteColumn(c, route)
+                routesAdded += 1
+        print(pricingRound, '   ', routesAdded, '   ', master.ObjVal, '   ', int(time() - programStartTime))
+        pricingRound += 1
+        if routesAdded == 0:
+            if routeLabelsPerArc is None:
+                break
+            # Heuristic pricing can miss routes, so the bound needs a round of exact pricing to finish
+            print('Switching to exact pricing')
+            routeLabelsPerArc = None
+    routeLPBound = master.ObjVal
+    
+    for var in list(routeVars.values()) + list(idleCourierVars.values()):
+        var.vtype = GRB.BINARY
+    master.setParam('OutputFlag', 1)
+    master.optimize()
+    print()
+    print('LP bound ' + str(routeLPBound) + ', integer objective ' + str(master.ObjVal) + ', ' + str(len(routeVars)) + ' routes generated')
+    for o in orderData:
+        if uncoveredOrderVars[o].x > 0.5:
+            print('Error: No route delivers order ' + str(o) + '!')
+    for (c, route) in routeVars:
+        if routeVars[c, route].x > 0.5:
+            summary = "0"
+            for arc in route:
+                if arc[1] != ():
+                    summary += " -> " + str(arc[1])
+                summary += " -> " + str(arc[2])
+            print(c, summary)
+    print('Time = ' + str(time() - programStartTime))
+    sys.exit()
 
-print('Completed predecessor and successor calculations', time() - programStartTime)
 # ============================================================================
 
 nodesInModel = set()
@@ -497,35 +1026,40 @@ nodesInModel = set()
 # of when a courier can first get to the restaurant, and when the first order
 # is ready. The last interesting time per pair is the earlier of the group's
 # off time, and when the last order must have left the restaurant by.
+def NodeTimesForGroupRestaurant(group, restaurant):
+    offTime = courierGroups[group][1]
+    
+    # Calculate the first time that we should consider, i.e., the time for the first node for that group-restaurant pair
+    earliestArrivalTime = min(untimedArcData[arc][1] + untimedArcData[arc][3] for arc in untimedArcsByCourierNextRestaurant[(group, restaurant)])
+    earliestOrderTime = min(orderData[o][4] for o in ordersAtRestaurant[restaurant] if orderData[o][4] <= offTime if orderData[o][5] >= earliestArrivalTime)
+    firstInterestingTime = max(earliestArrivalTime, earliestOrderTime)
+    
+    # Calculate the last time that we should consider, i.e., the time for the last node for that group-restaurant pair
+    latestOrderTime = max(orderData[o][5] for o in ordersAtRestaurant[restaurant] if orderData[o][4] <= offTime if orderData[o][5] >= earliestArrivalTime)
+    lastInterestingTime = min(offTime, latestOrderTime)
+    
+    # If globalNodeIntervals is true, then all node times will be integer multiples of the nodeTimeInterval
+    if globalNodeIntervals:
+        possibleNodeTimes = list(i for i in range(0, globalOffTime + 1, nodeTimeInterval))
+        firstNodeTime = max(t for t in possibleNodeTimes if t <= firstInterestingTime)
+    else:
+        firstNodeTime = firstInterestingTime
+    
+    # All node times, when compared to other node times for the same group-restaurant pair, differ by an integer multiple of the nodeTimeInterval
+    # In addition, the node times are every time that fulfills the above condition and is less than or equal to the lastInterestingTime
+    nodeTimes = []
+    nodeTime = firstNodeTime
+    while nodeTime <= lastInterestingTime:
+        nodeTimes.append(nodeTime)
+        nodeTime += nodeTimeInterval
+    return nodeTimes
+
 nodeTimesByCourierRestaurant = defaultdict(list)
 for group, restaurant in untimedArcsByCourierRestaurant:
     if restaurant != 0:
-        offTime = courierGroups[group][1]
-        
-        # Calculate the first time that we should consider, i.e., the time for the first node for that group-restaurant pair
-        earliestArrivalTime = min(untimedArcData[arc][1] + untimedArcData[arc][3] for arc in untimedArcsByCourierNextRestaurant[(group, restaurant)])
-        earliestOrderTime = min(orderData[o][4] for o in ordersAtRestaurant[restaurant] if orderData[o][4] <= offTime if orderData[o][5] >= earliestArrivalTime)
-        firstInterestingTime = max(earliestArrivalTime, earliestOrderTime)
-        
-        # Calculate the last time that we should consider, i.e., the time for the last node for that group-restaurant pair
-        groupOffTime = courierGroups[group][1]
-        latestOrderTime = max(orderData[o][5] for o in ordersAtRestaurant[restaurant] if orderData[o][4] <= offTime if orderData[o][5] >= earliestArrivalTime)
-        lastInterestingTime = min(offTime, latestOrderTime)
-        
-        # If globalNodeIntervals is true, then all node times will be integer multiples of the nodeTimeInterval
-        if globalNodeIntervals:
-            possibleNodeTimes = list(i for i in range(0, globalOffTime + 1, nodeTimeInterval))
-            firstNodeTime = max(t for t in possibleNodeTimes if t <= firstInterestingTime)
-        else:
-            firstNodeTime = firstInterestingTime
-        
-        # All node times, when compared to other node times for the same group-restaurant pair, differ by an integer multiple of the nodeTimeInterval
-        # In addition, the node times are every time that fulfills the above condition and is less than or equal to the lastInterestingTime
-        nodeTime = firstNodeTime
-        while nodeTime <= lastInterestingTime:
+        for nodeTime in NodeTimesForGroupRestaurant(group, restaurant):
             nodesInModel.add((group, restaurant, nodeTime))
             nodeTimesByCourierRestaurant[(group, restaurant)].append(nodeTime)
-            nodeTime += nodeTimeInterval
 
 # In addition to having nodes for every group-restaurant pair, we need a starting node and an ending node for the couriers at 'home', or restaurant 0
 for group in courierGroups:
@@ -559,25 +1093,28 @@ timedArcs = set()
 # - s = (). In this case, the untimed arc is an entry arc, and the timed arc will only have one possible starting node (that is, home) and thus one corresponding ending node
 # - r2 = 0. In this case, the untimed arc is an exit arc, and the timed arc will only have one possible ending node (that is, home) and thus one corresponding starting node
 # Waiting arcs will be generated separately
-for ((g, c), s, r2) in untimedArcData:
-    r1, earliestDepartureTime, latestDepartureTime, travelTime = untimedArcData[((g,c), s, r2)]
+def TimedArcsFromUntimedArc(untimedArc, arcData=None):
+    # arcData can be given for untimed arcs that aren't in untimedArcData (yet)
+    ((g, c), s, r2) = untimedArc
+    if arcData is None:
+        arcData = untimedArcData[untimedArc]
+    r1, earliestDepartureTime, latestDepartureTime, travelTime = arcData
     if s == ():
         # untimed arc is an entry arc. The timed arc starts at home, and goes to the first possible node
-        arrivalTimeAtRestaurant = untimedArcData[((g,c),s,r2)][1] + untimedArcData[((g,c),s,r2)][3]
+        arrivalTimeAtRestaurant = earliestDepartureTime + travelTime
         if min(nodeTimesByCourierRestaurant[(g,r2)]) > arrivalTimeAtRestaurant:
             arrivalNodeTime = min(nodeTimesByCourierRestaurant[(g,r2)])
         else:
             arrivalNodeTime = max(t for t in nodeTimesByCourierRestaurant[(g,r2)] if t <= arrivalTimeAtRestaurant)
-        timedArcs.add(((g,c), 0, 0, (), r2, arrivalNodeTime))
+        return [((g,c), 0, 0, (), r2, arrivalNodeTime)]
     
     elif r2 == 0:
         # untimed arc is an exit arc. The timed arc ends at home, and comes from the last possible node
         departureNodeTime = max(t for t in nodeTimesByCourierRestaurant[(g,r1)] if t <= latestDepartureTime)
-        timedArcs.add(((g,c), r1, departureNodeTime, s, r2, globalOffTime))
+        return [((g,c), r1, departureNodeTime, s, r2, globalOffTime)]
     
     else:
         # untimed arc is a main arc, going from restaurant to restaurant while delivering a sequence of orders        
-        offTime = courierGroups[g][1]
         nodeTimesAtLeavingRestaurant = nodeTimesByCourierRestaurant[(g, r1)]
         nodeTimesAtArrivingRestaurant = nodeTimesByCourierRestaurant[(g, r2)]
         nodeTimesAtLeavingRestaurant.sort()
@@ -589,7 +1126,7 @@ for ((g, c), s, r2) in untimedArcData:
         else:
             print('Error: No early enough node time for arc conversion to timed arc!', ((g, c), s, r2))
             if min(nodeTimesAtLeavingRestaurant) > latestDepartureTime:
-                break
+                return []
             else:
                 firstArcLeavingTime = min(nodeTimesAtLeavingRestaurant)
         
@@ -598,7 +1135,7 @@ for ((g, c), s, r2) in untimedArcData:
         currentNodeTime = firstArcLeavingTime
         timedArcsToAdd = []
         while currentNodeTime <= latestDepartureTime:
-            arrivalAtNextRestaurant = max(currentNodeTime, earliestLeavingTime) + travelTime
+            arrivalAtNextRestaurant = max(currentNodeTime, earliestDepartureTime) + travelTime
             # Two cases: there are nodes at the arriving restaurant around when the courier arrives, or not
             if min(nodeTimesAtArrivingRestaurant) <= arrivalAtNextRestaurant:
                 # Arrival node time is given by the latest node time at the restaurant, that is before the arrival time
@@ -628,47 +1165,66 @@ for ((g, c), s, r2) in untimedArcData:
                     # timedArc2 has an earlier leaving node time
                     dominatedArcs.append(timedArc2)
         
-        # Add all the newly generated timed arcs, ignoring those that were dominated
-        for timedArc in timedArcsToAdd:
-            if timedArc not in dominatedArcs:
-                timedArcs.add(timedArc)
-    
+        # Return all the newly generated timed arcs, ignoring those that were dominated
+        return [timedArc for timedArc in timedArcsToAdd if timedArc not in dominatedArcs]
+
 # Waiting arcs
 def NodeTime(node):
     return node[2]
-for pair in nodesByOfftimeRestaurantPair:
-    nodeList = nodesByOfftimeRestaurantPair[pair]
-    if len(nodeList) > 0:
-        nodeList.sort(key = NodeTime)
-        for i in range(1, len(nodeList)):
-            timedArcs.add(((pair[0],0), pair[1], nodeList[i-1][2], (), pair[1], nodeList[i][2]))
-GiveMeAStatusUpdate('timed arcs', timedArcs)
+
+def GenerateTimedArcs():
+    # Yields the timed arcs of every untimed arc, then the waiting arcs
+    for untimedArc in untimedArcData:
+        for arc in TimedArcsFromUntimedArc(untimedArc):
+            yield arc
+    for pair in nodesByOfftimeRestaurantPair:
+        nodeList = nodesByOfftimeRestaurantPair[pair]
+        if len(nodeList) > 0:
+            nodeList.sort(key = NodeTime)
+            for i in range(1, len(nodeList)):
+                yield ((pair[0],0), pair[1], nodeList[i-1][2], (), pair[1], nodeList[i][2])
+
+if not lowMemoryMode:
+    timedArcs.update(GenerateTimedArcs())
+    GiveMeAStatusUpdate('timed arcs', timedArcs)
 
 arcsByDepartureNode = defaultdict(list) # (g,r1,t1): [timedArc1, timedArc2, ...]
 arcsByArrivalNode = defaultdict(list) # (g,r2,t2): [timedArc1, timedArc2, ...]
 arcsByCourier = defaultdict(list) # g: [timedArc1, timedArc2, ...]
 arcsByOrder = {o: [] for o in orderData}
-outArcsByCourier = {c: [] for c in courierData}
+outArcsByCourier = {c: [] for c in courierMultiplicity}
 departureArcsByCourierAndRestaurant = defaultdict(list) # (g,r1): [timedArc1, timedArc2, ...]
 arrivalArcsByCourierAndRestaurant = defaultdict(list) # (g,r2): [timedArc1, timedArc2, ...]
 arcsByUntimedArc = {u: [] for u in untimedArcData}
 waitingArcsByGroupRestaurant = defaultdict(list)
 
-for arc in timedArcs:
+def IndexTimedArc(arc):
     ((g,c),r1,t1,s,r2,t2) = arc
-    arcsByDepartureNode[g,r1,t1].append(arc)
-    arcsByArrivalNode[g,r2,t2].append(arc)
-    arcsByCourier[g].append(arc)
-    departureArcsByCourierAndRestaurant[g,r1].append(arc)
-    arrivalArcsByCourierAndRestaurant[g,r2].append(arc)
+    arcsByDepartureNode.setdefault((g,r1,t1), []).append(arc)
+    arcsByArrivalNode.setdefault((g,r2,t2), []).append(arc)
+    arcsByCourier.setdefault(g, []).append(arc)
     for o in s:
         arcsByOrder[o].append(arc)
     if r1 == 0 and r2 != 0:
         outArcsByCourier[c].append(arc)
     if r1 != r2 or s != ():
         arcsByUntimedArc[(g,c),s,r2].append(arc)
+    if lowMemoryMode:
+        return
+    departureArcsByCourierAndRestaurant.setdefault((g,r1), []).append(arc)
+    arrivalArcsByCourierAndRestaurant.setdefault((g,r2), []).append(arc)
     if r1 == r2 and s == ():
-        waitingArcsByGroupRestaurant[g,r1].append(arc)
+        waitingArcsByGroupRestaurant.setdefault((g,r1), []).append(arc)
+
+if not lowMemoryMode:
+    for arc in timedArcs:
+        IndexTimedArc(arc)
+else:
+    # The timed arcs are only kept in the indexes
+    for arc in GenerateTimedArcs():
+        IndexTimedArc(arc)
+    print(str(sum(len(arcsByCourier[g]) for g in arcsByCourier)) + ' timed arcs ' + str(time() - programStartTime))
+    ReportMemory()
 
 arcsByDepartureNode = dict(arcsByDepartureNode)
 arcsByArrivalNode = dict(arcsByArrivalNode)
@@ -687,6 +1243,174 @@ for untimedArc in arcsByUntimedArc:
     if len(arcsByUntimedArc[untimedArc]) == 0:
         print('Error: Untimed arc ' + str(untimedArc) + ' has no matching timed arcs!')
 
+if validateStages:
+    from MDRPValidation import ValidateStages
+    ValidateStages(globals())
+    print('Stages validated ' + str(time() - programStartTime))
+
+if rollingHorizon:
+    # Orders that no courier can reach in this window would make it infeasible.
+    # Those that were due in this window are missed, and look-ahead orders are
+    # left for the next window.
+    unreachableOrders = [order for order in arcsByOrder if len(arcsByOrder[order]) == 0]
+    for order in unreachableOrders:
+        if orderData[order][4] < windowEnd:
+            missedOrders.append(order)
+        ordersAtRestaurant[orderData[order][3]].remove(order)
+        del orderData[order], arcsByOrder[order]
+    if len(unreachableOrders) > 0:
+        print('Orders left out of the window as no courier can reach them ' + str(unreachableOrders))
+
+# ============================================================================
+# Decomposition by courier group
+# Courier groups only share the deliverOrders constraints. Relaxing these
+# into the objective with Lagrange multipliers leaves one independent
+# subproblem per group, which are solved in parallel worker processes. The
+# multipliers are updated by subgradient optimisation. The best bound is then
+# added to the full model as a cut, and the best subproblem solutions are
+# used as its MIP start. The subproblems leave out the illegal path callback,
+# so the bound is still valid.
+# ============================================================================
+
+def BuildGroupSubproblem(group, env):
+    """
+    Build the model for a single courier group, without the constraints that
+    link it to the other groups. Each order is delivered at most once by the
+    group, which is implied by the full model.
+    """
+    sub = Model('MDRP group ' + str(group), env=env)
+    subArcs = {}
+    for arc in arcsByCourier[group]:
+        if arc[2] <= arc[5]:
+            if arc[1] == arc[4] and arc[3] == ():
+                subArcs[arc] = sub.addVar()
+            else:
+                subArcs[arc] = sub.addVar(vtype=ArcVType(arc))
+    subStart = {c: sub.addVar(ub=courierMultiplicity[c], vtype=GRB.BINARY if courierMultiplicity[c] == 1 else GRB.INTEGER) for c in courierGroups[group][0]}
+    subPayment = sub.addVar()
+    
+    subArcsByOrder = defaultdict(list)
+    for arc in subArcs:
+        for o in arc[3]:
+            subArcsByOrder[o].append(arc)
+    for (g, restaurant) in nodeTimesByCourierRestaurant:
+        if g == group and restaurant != 0:
+            for t in nodeTimesByCourierRestaurant[g, restaurant]:
+                sub.addConstr(quicksum(subArcs[arc] for arc in arcsByDepartureNode[g,restaurant,t]) == quicksum(subArcs[arc] for arc in arcsByArrivalNode[g,restaurant,t]))
+    for c in courierGroups[group][0]:
+        sub.addConstr(quicksum(subArcs[arc] for arc in outArcsByCourier[c]) == subStart[c])
+    for o in subArcsByOrder:
+        sub.addConstr(quicksum(subArcs[arc] for arc in subArcsByOrder[o]) <= 1)
+    if considerObjective:
+        sub.addConstr(subPayment >= quicksum(subArcs[arc] * len(arc[3]) * payPerDelivery for arc in subArcs) + quicksum((courierData[c][3] - courierData[c][2]) * minPayPerHour / 60 * (courierMultiplicity[c]-subStart[c]) for c in courierGroups[group][0]))
+        sub.addConstr(subPayment >= quicksum((courierData[c][3] - courierData[c][2]) * minPayPerHour / 60 * courierMultiplicity[c] for c in courierGroups[group][0]))
+    else:
+        sub.addConstr(subPayment == 0)
+    return sub, subArcs, subPayment
+
+def LagrangianWorker(groups, connection):
+    """
+    Solve the subproblems for the given courier groups every time the master
+    sends new multipliers, until it sends None. Sends back the bound and the
+    used arcs for each group.
+    """
+    env = Env()
+    env.setParam('OutputFlag', 0)
+    env.setParam('Threads', 1)
+    env.setParam('TimeLimit', lagrangianSubproblemTimeLimit)
+    subproblems = {group: BuildGroupSubproblem(group, env) for group in groups}
+    while True:
+        multipliers = connection.recv()
+        if multipliers is None:
+            break
+        results = {}
+        for group in groups:
+            sub, subArcs, subPayment = subproblems[group]
+            sub.setObjective(subPayment - quicksum(sum(multipliers[o] for o in arc[3]) * subArcs[arc] for arc in subArcs if arc[3] != ()))
+            sub.optimize()
+            # ObjBound is still a valid bound for the group if the time limit is hit
+            usedArcs = {arc: subArcs[arc].x for arc in subArcs if subArcs[arc].x > 0.01} if sub.SolCount > 0 else {}
+            results[group] = (sub.ObjBound, usedArcs)
+        connection.send(results)
+    connection.close()
+
+lagrangianConnections = []
+lagrangianWorkers = []
+
+def StartLagrangianWorkers():
+    """
+    Fork the worker processes, each building the subproblems for its share of
+    the courier groups. This is done before the full model is built, so the
+    workers don't inherit an active Gurobi environment.
+    """
+    groups = list(courierGroups)
+    processCount = min(lagrangianProcesses or os.cpu_count(), len(groups))
+    context = multiprocessing.get_context('fork')
+    for i in range(processCount):
+        parentConnection, childConnection = context.Pipe()
+        worker = context.Process(target=LagrangianWorker, args=(groups[i::processCount], childConnection))
+        worker.start()
+        lagrangianConnections.append(parentConnection)
+        lagrangianWorkers.append(worker)
+
+def SolveLagrangianDual():
+    """
+    Subgradient optimisation of the Lagrangian dual of the deliverOrders
+    constraints. The step size uses a target a little above the best bound,
+    and is halved whenever the bound hasn't improved for five iterations.
+    
+    returns:
+        bestBound, the best lower bound found
+        bestArcValues, {timedArc: value} for the iteration that found it
+    """
+    multipliers = {o: payPerDelivery for o in orderData}
+    bestBound = -GRB.INFINITY
+    bestArcValues = {}
+    stepScale = 2
+    iterationsWithoutImprovement = 0
+    print('Iteration, bound, best bound, orders not covered once, time')
+    for iteration in range(lagrangianIterations):
+        for connection in lagrangianConnections:
+            connection.send(multipliers)
+        bound = sum(multipliers.values())
+        arcValues = {}
+        for connection in lagrangianConnections:
+            for group, (groupBound, usedArcs) in connection.recv().items():
+                bound += groupBound
+                arcValues.update(usedArcs)
+        
+        deliveries = {o: 0 for o in orderData}
+        for arc in arcValues:
+            for o in arc[3]:
+                deliveries[o] += arcValues[arc]
+        subgradient = {o: 1 - deliveries[o] for o in orderData}
+        
+        if bound > bestBound + 0.001:
+            bestBound = bound
+            bestArcValues = arcValues
+            iterationsWithoutImprovement = 0
+        else:
+            iterationsWithoutImprovement += 1
+            if iterationsWithoutImprovement >= 5:
+                stepScale /= 2
+                iterationsWithoutImprovement = 0
+        violations = sum(1 for o in subgradient if abs(subgradient[o]) > 0.01)
+        print(iteration, '   ', bound, '   ', bestBound, '   ', violations, '   ', int(time() - programStartTime))
+        if violations == 0:
+            # Subproblem solutions deliver every order once, no better bound exists
+            break
+        
+        target = bestBound + 0.05 * abs(bestBound) + 1
+        step = stepScale * (target - bound) / sum(subgradient[o] ** 2 for o in orderData)
+        for o in orderData:
+            multipliers[o] += step * subgradient[o]
+    
+    for connection in lagrangianConnections:
+        connection.send(None)
+    for worker in lagrangianWorkers:
+        worker.join()
+    return bestBound, bestArcValues
+
 # ============================================================================
 # Model Setup
 # - Set variables
@@ -694,24 +1418,275 @@ for untimedArc in arcsByUntimedArc:
 # - Set general constraints
 # ============================================================================
 
+def ArcVType(arc):
+    # Entry arcs of courier classes can be used by each courier in the class
+    if arc[0][1] != 0 and courierMultiplicity.get(arc[0][1], 1) > 1:
+        return GRB.INTEGER
+    return GRB.BINARY
+
+if decomposeByCourierGroup:
+    StartLagrangianWorkers()
+
 print()
 m = Model('MDRP')
 
-arcs = {arc: m.addVar() for arc in timedArcs if arc[2] <= arc[5]}
-doesThisCourierStart = {c: m.addVar() for c in courierData}
+if not lowMemoryMode:
+    arcs = {arc: m.addVar() for arc in timedArcs if arc[2] <= arc[5]}
+else:
+    arcs = {arc: m.addVar() for g in arcsByCourier for arc in arcsByCourier[g] if arc[2] <= arc[5]}
+doesThisCourierStart = {c: m.addVar(ub=courierMultiplicity[c] if aggregateCourierClasses else GRB.INFINITY) for c in courierMultiplicity}
 
 if considerObjective:
     payments = {group: m.addVar() for group in courierGroups}
     m.setObjective(quicksum(payments[g] for g in courierGroups))
-    paidPerDelivery = {g: m.addConstr(payments[g] >= quicksum(arcs[arc] * len(arc[3]) * payPerDelivery for arc in arcsByCourier[g]) + quicksum((courierData[c][3] - courierData[c][2]) * minPayPerHour / 60 * (1-doesThisCourierStart[c]) for c in courierGroups[g][0])) for g in courierGroups}
-    paidPerTime = {g: m.addConstr(payments[g] >= quicksum((courierData[courier][3] - courierData[courier][2]) * minPayPerHour / 60 for courier in courierGroups[g][0])) for g in courierGroups}
+    paidPerDelivery = {g: m.addConstr(payments[g] >= quicksum(arcs[arc] * len(arc[3]) * payPerDelivery for arc in arcsByCourier[g]) + quicksum((courierData[c][3] - courierData[c][2]) * minPayPerHour / 60 * (courierMultiplicity[c]-doesThisCourierStart[c]) for c in courierGroups[g][0])) for g in courierGroups}
+    paidPerTime = {g: m.addConstr(payments[g] >= quicksum((courierData[courier][3] - courierData[courier][2]) * minPayPerHour / 60 * courierMultiplicity[courier] for courier in courierGroups[g][0])) for g in courierGroups}
 
 flowConstraint = {node: m.addConstr(quicksum(arcs[arc] for arc in arcsByDepartureNode[node]) == quicksum(arcs[arc] for arc in arcsByArrivalNode[node])) for node in nodesInModel if node[1] != 0}
-outArcsIffLeaveHome = {c: m.addConstr(quicksum(arcs[arc] for arc in outArcsByCourier[c]) == doesThisCourierStart[c]) for c in courierData}
+outArcsIffLeaveHome = {c: m.addConstr(quicksum(arcs[arc] for arc in outArcsByCourier[c]) == doesThisCourierStart[c]) for c in courierMultiplicity}
 deliverOrders = {o: m.addConstr(quicksum(arcs[arc] for arc in arcsByOrder[o]) == 1) for o in orderData}
 print('Completed main constraints, time = ' + str(time() - programStartTime))
 print()
 
+# ============================================================================
+# Adding to the model
+# New untimed arcs can be added to the built model as columns, along with any
+# nodes they need. Used for lazy arc generation and online re-optimisation.
+# ============================================================================
+
+onlineArcHeap = [] # [(startTime, count, timedArc), ...], for arcs not yet fixed
+onlineArcCounter = itertools.count()
+pricingLazyArcs = False # the lazy arc loop needs the duals of the LP, so its arcs are continuous until the final solve
+validInequalitiesByArrival = defaultdict(list) # (group, restaurant): [(untimedArc, constraint, isPredecessorInequality), ...]
+validInequalitiesByDeparture = defaultdict(list)
+
+def StartTimeOfTimedArc(arc):
+    # Entry arcs start when the courier's shift does, all others at their departure node
+    ((g,c),r1,t1,s,r2,t2) = arc
+    if c != 0:
+        return courierData[c][2]
+    return t1
+
+def ValidInequalitiesForNewUntimedArc(untimedArc):
+    """
+    Returns the VI constraints that the new untimed arc is a valid predecessor
+    or successor in. Its timed arcs have to be added to the right hand side of
+    these, otherwise the VIs would cut off solutions that use it.
+    """
+    ((group, _), orders, arrivalRestaurant) = untimedArc
+    departureRestaurant, earliestLeavingTime, latestLeavingTime, travelTime = untimedArcData[untimedArc]
+    foundConstraints = []
+    for arc, constraint, isPredecessorInequality in (validInequalitiesByArrival.get((group, arrivalRestaurant), [])
+                                                     + validInequalitiesByDeparture.get((group, departureRestaurant), [])):
+        if set(arc[1]) & set(orders) == set():
+            if isPredecessorInequality:
+                if earliestLeavingTime + travelTime <= untimedArcData[arc][2]:
+                    foundConstraints.append(constraint)
+            elif untimedArcData[arc][1] + untimedArcData[arc][3] <= latestLeavingTime:
+                foundConstraints.append(constraint)
+    return foundConstraints
+
+def AddTimedArcToModel(arc, validInequalities):
+    """
+    Add a variable for a new timed arc to the model, with its coefficients in
+    every constraint that it is part of. validInequalities are the VI
+    constraints that the arc appears in as a predecessor or successor.
+    """
+    ((g,c),r1,t1,s,r2,t2) = arc
+    if t1 > t2 or (r1 != 0 and (g,r1,t1) not in flowConstraint) or (r2 != 0 and (g,r2,t2) not in flowConstraint):
+        print('Error: new timed arc does not match the nodes in the model!', arc)
+        return
+    coefficients = []
+    constraints = []
+    if r1 != 0:
+        coefficients.append(1)
+        constraints.append(flowConstraint[g,r1,t1])
+    if r2 != 0:
+        coefficients.append(-1)
+        constraints.append(flowConstraint[g,r2,t2])
+    for o in s:
+        coefficients.append(1)
+        constraints.append(deliverOrders[o])
+    if r1 == 0 and r2 != 0:
+        coefficients.append(1)
+        constraints.append(outArcsIffLeaveHome[c])
+    if considerObjective and len(s) > 0:
+        coefficients.append(-len(s) * payPerDelivery)
+        constraints.append(paidPerDelivery[g])
+    for constraint in validInequalities:
+        coefficients.append(-1)
+        constraints.append(constraint)
+    if (r1 == r2 and s == ()) or pricingLazyArcs:
+        arcs[arc] = m.addVar(column=Column(coefficients, constraints))
+    else:
+        arcs[arc] = m.addVar(vtype=GRB.BINARY, column=Column(coefficients, constraints))
+    timedArcs.add(arc)
+    IndexTimedArc(arc)
+    heapq.heappush(onlineArcHeap, (StartTimeOfTimedArc(arc), next(onlineArcCounter), arc))
+
+def AddNodesForGroupRestaurant(group, restaurant):
+    """
+    Extend the nodes of the group-restaurant pair to cover the times needed by
+    its untimed arcs. Nodes are only ever added before the first or after the
+    last existing node. Returns the waiting arcs that join the new nodes up.
+    """
+    requiredNodeTimes = NodeTimesForGroupRestaurant(group, restaurant)
+    nodeTimes = nodeTimesByCourierRestaurant.setdefault((group, restaurant), [])
+    nodeTimes.sort()
+    if len(nodeTimes) == 0:
+        newNodeTimes = requiredNodeTimes
+    else:
+        newNodeTimes = []
+        nodeTime = nodeTimes[0] - nodeTimeInterval
+        while len(requiredNodeTimes) > 0 and nodeTime >= requiredNodeTimes[0]:
+            newNodeTimes.append(nodeTime)
+            nodeTime -= nodeTimeInterval
+        nodeTime = nodeTimes[-1] + nodeTimeInterval
+        while len(requiredNodeTimes) > 0 and nodeTime <= requiredNodeTimes[-1]:
+            newNodeTimes.append(nodeTime)
+            nodeTime += nodeTimeInterval
+    for nodeTime in newNodeTimes:
+        node = (group, restaurant, nodeTime)
+        nodesInModel.add(node)
+        nodesByOfftimeRestaurantPair.setdefault((group, restaurant), []).append(node)
+        flowConstraint[node] = m.addConstr(LinExpr() == 0)
+        nodeTimes.append(nodeTime)
+    nodeTimes.sort()
+    newWaitingArcs = []
+    for i in range(1, len(nodeTimes)):
+        if nodeTimes[i-1] in newNodeTimes or nodeTimes[i] in newNodeTimes:
+            newWaitingArcs.append(((group,0), restaurant, nodeTimes[i-1], (), restaurant, nodeTimes[i]))
+    return newWaitingArcs
+
+def AddUntimedArcsToModel(newUntimedArcs):
+    # The arcs' data must already be in untimedArcData
+    affectedPairs = set()
+    for arc in newUntimedArcs:
+        untimedArcs.add(arc)
+        arcsByUntimedArc[arc] = []
+        IndexUntimedArc(arc)
+        if arc[2] != 0:
+            affectedPairs.add((arc[0][0], arc[2]))
+        if arc[1] != ():
+            affectedPairs.add((arc[0][0], untimedArcData[arc][0]))
+    newWaitingArcs = []
+    for group, restaurant in affectedPairs:
+        newWaitingArcs += AddNodesForGroupRestaurant(group, restaurant)
+    m.update()
+    for arc in newWaitingArcs:
+        AddTimedArcToModel(arc, [])
+    for untimedArc in newUntimedArcs:
+        validInequalities = ValidInequalitiesForNewUntimedArc(untimedArc)
+        for timedArc in TimedArcsFromUntimedArc(untimedArc):
+            AddTimedArcToModel(timedArc, validInequalities)
+
+
+# ============================================================================
+# Lazy arc generation
+# The model starts with only single order bundles. Each round, the LP is
+# solved, and the candidate untimed arcs are priced using its duals.
+# Candidates with a timed arc of negative reduced cost are added to the model.
+# Once no candidates price out, the bundles that made it into the model are
+# extended by another order, and the pairs and untimed arcs of the new
+# bundles become the next candidates. Only bundles that were added can be
+# extended, so larger bundles are only generated where they could help.
+# ============================================================================
+
+lazyCandidateArcs = {} # untimedArc: untimedArcData
+
+def ReducedCostOfTimedArc(arc, flowDuals, orderDuals, paymentDuals):
+    # The arc's column is the same as in AddTimedArcToModel, without any VIs
+    ((g,c),r1,t1,s,r2,t2) = arc
+    dualTotal = sum(orderDuals[o] for o in s)
+    if r1 != 0:
+        dualTotal += flowDuals[g,r1,t1]
+    if r2 != 0:
+        dualTotal -= flowDuals[g,r2,t2]
+    if considerObjective:
+        dualTotal -= len(s) * payPerDelivery * paymentDuals[g]
+    return -dualTotal
+
+def GenerateLazyCandidates(bundles, restaurant):
+    # Cache the bundles, their pairs and their untimed and timed arcs as candidates
+    for sequence in bundles:
+        sequencesByRestaurantThenOrderSet.setdefault(restaurant, defaultdict(list))[frozenset(sequence)].append(sequence)
+        for (_, nextRestaurant) in FindPairsForSequence(sequence, RestaurantsReachableAfterSequence(sequence)):
+            if (sequence, nextRestaurant) in sequenceNextRestaurantData:
+                for group in courierGroups:
+                    arcData = MainUntimedArcData(sequence, nextRestaurant, group)
+                    if arcData is not None:
+                        lazyCandidateArcs[((group, 0), sequence, nextRestaurant)] = arcData
+        for group in courierGroups:
+            arcData = ExitUntimedArcData(sequence, group)
+            if arcData is not None:
+                lazyCandidateArcs[((group, 0), sequence, 0)] = arcData
+
+if lazyArcGeneration:
+    m.setParam('OutputFlag', 0)
+    pricingLazyArcs = True
+    lazyBundleFrontier = {restaurant: [(order,) for order in ordersAtRestaurant[restaurant]] for restaurant in restaurantData}
+    bundleSize = 1
+    print('Bundle size, candidate untimed arcs, untimed arcs added, LP objective, time')
+    while True:
+        m.optimize()
+        flowDuals = dict(zip(flowConstraint.keys(), m.getAttr('Pi', list(flowConstraint.values()))))
+        orderDuals = dict(zip(deliverOrders.keys(), m.getAttr('Pi', list(deliverOrders.values()))))
+        paymentDuals = dict(zip(paidPerDelivery.keys(), m.getAttr('Pi', list(paidPerDelivery.values())))) if considerObjective else {}
+        
+        pricedArcs = []
+        for untimedArc in lazyCandidateArcs:
+            (g, _), _, r2 = untimedArc
+            arcData = lazyCandidateArcs[untimedArc]
+            # Candidates that need new nodes can't be priced, and are always added
+            if (g, arcData[0]) not in nodeTimesByCourierRestaurant or (g, r2) not in nodeTimesByCourierRestaurant:
+                pricedArcs.append(untimedArc)
+                continue
+            timedArcsForCandidate = TimedArcsFromUntimedArc(untimedArc, arcData)
+            if any((arc[1] != 0 and (arc[0][0], arc[1], arc[2]) not in flowDuals) or (arc[4] != 0 and (arc[0][0], arc[4], arc[5]) not in flowDuals) for arc in timedArcsForCandidate):
+                pricedArcs.append(untimedArc)
+            elif len(timedArcsForCandidate) > 0 and min(ReducedCostOfTimedArc(arc, flowDuals, orderDuals, paymentDuals) for arc in timedArcsForCandidate) < -0.0001:
+                pricedArcs.append(untimedArc)
+        for untimedArc in pricedArcs:
+            untimedArcData[untimedArc] = lazyCandidateArcs[untimedArc]
+            del lazyCandidateArcs[untimedArc]
+            if untimedArc[2] == 0:
+                exitUntimedArcsByCourierRestaurant.setdefault((untimedArc[0][0], untimedArcData[untimedArc][0]), []).append(untimedArc)
+            frontier = lazyBundleFrontier.setdefault(untimedArcData[untimedArc][0], [])
+            if untimedArc[1] not in frontier:
+                frontier.append(untimedArc[1])
+        AddUntimedArcsToModel(pricedArcs)
+        print(bundleSize, '   ', len(lazyCandidateArcs) + len(pricedArcs), '   ', len(pricedArcs), '   ', m.ObjVal, '   ', int(time() - programStartTime))
+        
+        if len(pricedArcs) == 0:
+            # Nothing more prices out at this size, move on to bigger bundles
+            if limitBundlesToSizeOne or (maxBundleSize is not None and bundleSize >= maxBundleSize):
+                break
+            bundleSize += 1
+            lazyCandidateArcs.clear()
+            for restaurant in lazyBundleFrontier:
+                newBundles = ExtendBundlesByOneOrder([bundle for bundle in lazyBundleFrontier[restaurant] if len(bundle) == bundleSize - 1], restaurant, sequenceData)
+                GenerateLazyCandidates(newBundles, restaurant)
+            if len(lazyCandidateArcs) == 0:
+                break
+    pricingLazyArcs = False
+    GiveMeAStatusUpdate('untimed arcs after lazy generation', untimedArcData)
+    if addValidInequalityConstraints and not addVIRecursively:
+        # The added arcs can be predecessors and successors of the arcs already in the model too
+        for arc in untimedArcData:
+            predecessorsForUntimedArc[arc] = CalculatePredecessorsFromUntimedArc(arc)
+            successorsForUntimedArc[arc] = CalculateSuccessorsFromUntimedArc(arc)
+        print('Recalculated predecessors and successors', time() - programStartTime)
+
+if decomposeByCourierGroup:
+    print('Decomposing into ' + str(len(courierGroups)) + ' courier group subproblems')
+    lagrangianBound, lagrangianArcValues = SolveLagrangianDual()
+    if considerObjective:
+        lagrangianBoundConstraint = m.addConstr(quicksum(payments[g] for g in courierGroups) >= lagrangianBound)
+    for arc in arcs:
+        arcs[arc].Start = lagrangianArcValues.get(arc, 0)
+    print('Lagrangian bound ' + str(lagrangianBound) + ', time = ' + str(time() - programStartTime))
+    print()
+
 # ============================================================================
 # Model Solving
 # - Solve linear model/Add VI constraints
@@ -719,7 +1694,12 @@ print()
 # - Solve callback
 # ============================================================================
 
+if exportModel:
+    # The LP parameters are tuned on this, as it's the LP of the first VI round
+    ExportFirstRoundLP(m, exportDirectory + grubhubInstance)
+
 if addValidInequalityConstraints:
+    ApplyTunedParameters(m, 'LP', tunedParametersFile)
     if not addVIRecursively:
         print('Adding all VI constraints')
         # Code for doing all VIs:
@@ -801,174 +1781,269 @@ if addValidInequalityConstraints:
 print()
 print('Time = ' + str(time() - programStartTime))
 
-callbackCuts = []
-lazyVICuts = []
-def ComputeAndRemoveMinimalIllegalNetwork(listOfTimedArcs):
-    # Take the list of timed arcs, and convert them to untimed arcs
-    usedUntimedArcs = []
-    usedCouriers = set()
-    for ((g,c), _, _, s, r2, _) in listOfTimedArcs:
-        untimedArc = ((g,c), s, r2)
-        if untimedArc in usedUntimedArcs:
-            print('Error! Duplicate use of untimed arc in solution!', untimedArc)
-        usedUntimedArcs.append(untimedArc)
-        if c != 0:
-            usedCouriers.add(c)
-    
-    # Find all possible predecessor-successor pairs
-    successorsForArc = defaultdict(list)
-    predecessorsForArc = defaultdict(list)
-    for (arc1, arc2) in itertools.combinations(usedUntimedArcs, 2):
-        arc1Data = untimedArcData[arc1]
-        arc2Data = untimedArcData[arc2]
-        if arc1Data[1] + arc1Data[3] <= arc2Data[2] and arc1[2] == arc2Data[0] and arc1[2] != 0:
-            # Earliest arrival before latest departure
-            # The arrival location of the first arc is the departure location of the second
-            # The first arc does not head home
-            successorsForArc[arc1].append(arc2)
-            predecessorsForArc[arc2].append(arc1)
-        if arc2Data[1] + arc2Data[3] <= arc1Data[2] and arc2[2] == arc1Data[0] and arc2[2] != 0:
-            successorsForArc[arc2].append(arc1)
-            predecessorsForArc[arc1].append(arc2)
-    successorsForArc = dict(successorsForArc)
-    predecessorsForArc = dict(predecessorsForArc)
-    
-    # Add lazy constraints to ensure that all used arcs have successors and predecessors
-    for arc in usedUntimedArcs:
-        if arc not in successorsForArc and arc[2] != 0:
-            earliestArrival = untimedArcData[arc][1] + untimedArcData[arc][3]
-            arrivalRestaurant = arc[2]
-            group = arc[0][0]
-            successors = []
-            for arc2 in untimedArcData:
-                if arc2[0][0] == group and untimedArcData[arc2][0] == arrivalRestaurant and untimedArcData[arc2][2] >= earliestArrival:
-                    successors.append(arc2)
-            if len(successors) == 0:
-                print('Error! Untimed arc has no successors!', arc)
-            m.cbLazy(quicksum(arcs[timedArc] for untimedArc in successors for timedArc in arcsByUntimedArc[untimedArc]) == quicksum(arcs[timedArc] for timedArc in arcsByUntimedArc[arc]))
-            lazyVICuts.append((1, arc, successors))
-        if arc not in predecessorsForArc and arc[1] != ():
-            latestDeparture = untimedArcData[arc][2]
-            departureRestaurant = untimedArcData[arc][0]
-            group = arc[0][0]
-            predecessors = []
-            for arc2 in untimedArcData:
-                if arc2[0][0] == group and arc2[2] == departureRestaurant and untimedArcData[arc2][1] + untimedArcData[arc2][3] <= latestDeparture:
-                    predecessors.append(arc2)
-            if len(predecessors) == 0:
-                print('Error! Untimed arc has no predecessors!', arc)
-            m.cbLazy(quicksum(arcs[timedArc] for untimedArc in predecessors for timedArc in arcsByUntimedArc[untimedArc]) == quicksum(arcs[timedArc] for timedArc in arcsByUntimedArc[arc]))
-            lazyVICuts.append((-1, arc, predecessors))
-            
-    # Create a new model
-    IPD = Model('Illegal Path Determination')
-    X = {(arc, successor): IPD.addVar(vtype=GRB.BINARY) for arc in successorsForArc for successor in successorsForArc[arc]}
-    Y = {(courier, arc): IPD.addVar(vtype=GRB.BINARY) for courier in usedCouriers for arc in usedUntimedArcs}
-    Z = {courier: IPD.addVar() for courier in usedCouriers}
-    T = {arc: IPD.addVar() for arc in usedUntimedArcs}
-    # T constraints
-    leaveAfterEarlyTime = {arc: IPD.addConstr(T[arc] >= untimedArcData[arc][1]) for arc in usedUntimedArcs}
-    leaveBeforeLateTime = {arc: IPD.addConstr(T[arc] <= untimedArcData[arc][2]) for arc in usedUntimedArcs}
-    # X constraints
-    enoughTimeForBothArcs = {(i,j): IPD.addConstr(T[i]+untimedArcData[i][3] <= T[j] + 
-                                  (untimedArcData[i][2]+untimedArcData[i][3]-untimedArcData[j][1])*(1-X[i,j]))
-                              for (i,j) in X}
-    predecessorArcsUsedOnce = {i: IPD.addConstr(quicksum(X[i,j] for j in successorsForArc[i]) == 1) for i in successorsForArc}
-    successorArcsUsedOnce = {j: IPD.addConstr(quicksum(X[i,j] for i in predecessorsForArc[j]) == 1) for j in predecessorsForArc}
-    # Y constraints
-    oneCourierDeliversPair = {}
-    for courier in usedCouriers:
-        for (arc, successor) in X:
-            oneCourierDeliversPair[(courier, arc, successor)] = IPD.addConstr(X[arc, successor] + Y[courier, arc] - 1 <= Y[courier, successor])
-    eachArcOneCourier = {arc: IPD.addConstr(quicksum(Y[courier, arc] for courier in usedCouriers) == 1) for arc in usedUntimedArcs if arc[0][1] == 0}
-    eachCourierOwnStart = {courier: IPD.addConstr(quicksum(Y[courier, arc] for arc in usedUntimedArcs if arc[0][1] == courier) == 1) for courier in usedCouriers}
-    # Z constraints
-    courierPayPerDelivery = {}
-    for courier in usedCouriers:
-        courierPayPerDelivery[courier] = IPD.addConstr(Z[courier] >= quicksum(Y[courier, arc] * len(arc[1]) * payPerDelivery for arc in usedUntimedArcs))
-    courierPayPerTime = {courier: IPD.addConstr(Z[courier] >= (courierData[courier][3] - courierData[courier][2]) * minPayPerHour / 60)}
-    # Objective
-    IPD.setObjective(quicksum(Z[courier] for courier in usedCouriers))
-    
-    # Solve the model
-    IPD.setParam('OutputFlag', 0)
-    IPD.optimize()
-    
-    # Compute IIS
-    if IPD.Status == GRB.INFEASIBLE:
-        IPD.computeIIS()
-    
-        # Compute Invalid Network
-        invalidUntimedArcs = set()
-        for arc in usedUntimedArcs:
-            if leaveAfterEarlyTime[arc].IISConstr or leaveBeforeLateTime[arc].IISConstr:
-                invalidUntimedArcs.add(arc)
-        for predecessor, successor in X:
-            if enoughTimeForBothArcs[predecessor, successor].IISConstr:
-                invalidUntimedArcs.add(predecessor)
-                invalidUntimedArcs.add(successor)
-            else:
-                if predecessorArcsUsedOnce[predecessor].IISConstr:
-                    invalidUntimedArcs.add(predecessor)
-                if successorArcsUsedOnce[successor].IISConstr:
-                    invalidUntimedArcs.add(successor)
-        
-        # Find possible replacement arcs
-        alternatePredecessorArcs = set()
-        alternateSuccessorArcs = set()
-        for arc in invalidUntimedArcs:
-            (group, _), _, arrivalRestaurant = arc
-            departureRestaurant, earliestLeavingTime, latestLeavingTime, travelTime = untimedArcData[arc]
-            for untimedArc in untimedArcsByCourierNextRestaurant[group, departureRestaurant]:
-                if untimedArc not in usedUntimedArcs:
-                    # Finding predecessors. A valid predecessor will have earliest
-                    # arrival time before the arc has to leave
-                    earliestArrival = untimedArcData[untimedArc][1] + untimedArcData[untimedArc][3]
-                    if earliestArrival <= latestLeavingTime:
-                        alternatePredecessorArcs.add(untimedArc)
-            
-            for untimedArc in untimedArcsByCourierRestaurant[group, arrivalRestaurant]:
-                if untimedArc not in usedUntimedArcs:
-                    # Finding successors. A valid successor will have latest leaving
-                    # time after the arc's earliest arrival
-                    earliestArrival = earliestLeavingTime + travelTime
-                    if earliestArrival <= untimedArcData[untimedArc][2]:
-                        alternateSuccessorArcs.add(untimedArc)
-        
-        # Remove Invalid Network
-        m.cbLazy(quicksum(arcs[timedArc] for untimedArc in invalidUntimedArcs for timedArc in arcsByUntimedArc[untimedArc])
-                  <= len(invalidUntimedArcs) - 1 + quicksum(arcs[timedArc] for untimedArc in alternatePredecessorArcs for timedArc in arcsByUntimedArc[untimedArc]))
-        m.cbLazy(quicksum(arcs[timedArc] for untimedArc in invalidUntimedArcs for timedArc in arcsByUntimedArc[untimedArc])
-                  <= len(invalidUntimedArcs) - 1 + quicksum(arcs[timedArc] for untimedArc in alternateSuccessorArcs for timedArc in arcsByUntimedArc[untimedArc]))
-        callbackCuts.append((-1, invalidUntimedArcs, alternatePredecessorArcs))
-        callbackCuts.append((1, invalidUntimedArcs, alternateSuccessorArcs))
-
-def Callback(model, where):
-    if where == GRB.Callback.MIPSOL:
-        timedArcValues = {arc: value for (arc, value) in zip(arcs.keys(), model.cbGetSolution(list(arcs.values())))}
-        usedTimedArcs = {arc: timedArcValues[arc] for arc in timedArcValues if timedArcValues[arc] > 0.01}
-        usedArcsByGroup = {group: [] for group in courierGroups}
-        for arc in usedTimedArcs:
-            if arc[3] != () or arc[1] != arc[4]:
-                usedArcsByGroup[arc[0][0]].append(arc)
-        for group in usedArcsByGroup:
-            if len(usedArcsByGroup[group]) > 0:
-                ComputeAndRemoveMinimalIllegalNetwork(usedArcsByGroup[group])
-
 for arc in arcs:
     if arc[1] != arc[4] or arc[3] != ():
-        arcs[arc].vtype=GRB.BINARY
+        arcs[arc].vtype=ArcVType(arc)
 
 for courier in doesThisCourierStart:
-    doesThisCourierStart[courier].vtype=GRB.BINARY
+    doesThisCourierStart[courier].vtype=GRB.BINARY if courierMultiplicity[courier] == 1 else GRB.INTEGER
+
+if lowMemoryMode:
+    # Only the callback and the solution summary are needed from here on
+    del arcsByDepartureNode, arcsByArrivalNode, arcsByCourier, arcsByOrder, outArcsByCourier
+    del nodesInModel, nodesByOfftimeRestaurantPair, nodeTimesByCourierRestaurant, exitUntimedArcsByCourierRestaurant
+    if addValidInequalityConstraints and not addVIRecursively:
+        del predecessorsForUntimedArc, successorsForUntimedArc
+    gc.collect()
+    print('Freed model building data, time = ' + str(time() - programStartTime))
+    ReportMemory()
+
+SetupCallback(m, arcs, {'untimedArcData': untimedArcData, 'arcsByUntimedArc': arcsByUntimedArc,
+                        'untimedArcsByCourierRestaurant': untimedArcsByCourierRestaurant,
+                        'untimedArcsByCourierNextRestaurant': untimedArcsByCourierNextRestaurant,
+                        'courierGroups': courierGroups, 'courierData': courierData, 'courierMultiplicity': courierMultiplicity,
+                        'payPerDelivery': payPerDelivery, 'minPayPerHour': minPayPerHour})
+if exportModel:
+    # Solve later with Solve Exported Model.py
+    ExportModel(exportDirectory + grubhubInstance)
+    print('Exported model to ' + exportDirectory + grubhubInstance + ', time = ' + str(time() - programStartTime))
+    sys.exit()
 
 m.setParam('Method', 2)
 m.setParam('LazyConstraints', 1)
 m.setParam('OutputFlag', 1)
+ApplyTunedParameters(m, 'MIP', tunedParametersFile)
+if telemetryFile is not None:
+    StartTelemetry(telemetryFile)
 m.optimize(Callback)
+if telemetryFile is not None and not onlineMode:
+    StopTelemetry()
 
 print('Time = ' + str(time() - programStartTime))
 
+# ============================================================================
+# Online re-optimisation
+# - Add orders and couriers to the kept model as they arrive
+# - Fix the parts of the plan that are already under way
+# - Re-solve, warm-started from the previous plan
+# ============================================================================
+
+onlinePlan = [] # variable values of the last solution, by variable index
+onlineFixedCouriers = set()
+
+def StartOnlineMode():
+    RecordOnlinePlan()
+    onlineArcHeap.clear()
+    for arc in arcs:
+        heapq.heappush(onlineArcHeap, (StartTimeOfTimedArc(arc), next(onlineArcCounter), arc))
+    # Index the valid inequalities by where a new predecessor or successor would have to be
+    if addValidInequalityConstraints:
+        if addVIRecursively:
+            for t in constraintDict:
+                inequalityType, arc = extraConstraints[t][:2]
+                if inequalityType == 1:
+                    validInequalitiesByArrival[arc[0][0], untimedArcData[arc][0]].append((arc, constraintDict[t], True))
+                else:
+                    validInequalitiesByDeparture[arc[0][0], arc[2]].append((arc, constraintDict[t], False))
+        else:
+            for (inequalityType, arc) in VIConstraints:
+                if inequalityType == -1:
+                    validInequalitiesByArrival[arc[0][0], untimedArcData[arc][0]].append((arc, VIConstraints[inequalityType, arc], True))
+                else:
+                    validInequalitiesByDeparture[arc[0][0], arc[2]].append((arc, VIConstraints[inequalityType, arc], False))
+
+def RecordOnlinePlan():
+    global onlinePlan
+    if m.SolCount > 0:
+        onlinePlan = m.getAttr('X', m.getVars())
+
+def AddOrder(order, data):
+    """
+    Add a newly placed order to the kept model
+    data is [x, y, placementTime, restaurant, readyTime], as in orders.txt
+    
+    Only the new bundles (those at the order's restaurant that contain it),
+    the new sequence-next restaurant pairs, and their untimed and timed arcs
+    are generated. Existing arcs keep their time windows, even if the new
+    order would have let them leave later.
+    """
+    eventStartTime = time()
+    orderData[order] = list(data)
+    CompleteOrderData(order)
+    restaurant = orderData[order][3]
+    ordersAtRestaurant[restaurant].append(order)
+    arcsByOrder[order] = []
+    deliverOrders[order] = m.addConstr(LinExpr() == 1)
+    
+    bundlesAtRestaurant = {}
+    FindOrderBundlesAtRestaurant(restaurant, bundlesAtRestaurant)
+    newSequences = [sequence for sequence in bundlesAtRestaurant if sequence not in sequenceData]
+    for sequence in newSequences:
+        sequenceData[sequence] = bundlesAtRestaurant[sequence]
+        sequencesByRestaurantThenOrderSet.setdefault(restaurant, defaultdict(list))[frozenset(sequence)].append(sequence)
+    
+    # New pairs come from the new sequences, or from old sequences that can now go on to the order's restaurant
+    createdPairs = []
+    for sequence in newSequences:
+        createdPairs += FindPairsForSequence(sequence, RestaurantsReachableAfterSequence(sequence))
+    newSequenceSet = set(newSequences)
+    for sequence in sequenceData:
+        if sequence not in newSequenceSet and (sequence, restaurant) not in sequenceNextRestaurantData:
+            createdPairs += FindPairsForSequence(sequence, [restaurant])
+    
+    newUntimedArcs = []
+    for (sequence, nextRestaurant) in createdPairs:
+        if (sequence, nextRestaurant) in sequenceNextRestaurantData:
+            for group in courierGroups:
+                arcData = MainUntimedArcData(sequence, nextRestaurant, group)
+                if arcData is not None:
+                    untimedArcData[((group, 0), sequence, nextRestaurant)] = arcData
+                    newUntimedArcs.append(((group, 0), sequence, nextRestaurant))
+    for sequence in newSequences:
+        for group in courierGroups:
+            arcData = ExitUntimedArcData(sequence, group)
+            if arcData is not None:
+                untimedArcData[((group, 0), sequence, 0)] = arcData
+                exitUntimedArcsByCourierRestaurant.setdefault((group, restaurant), []).append(((group, 0), sequence, 0))
+                newUntimedArcs.append(((group, 0), sequence, 0))
+    for group in courierGroups:
+        for courier in courierGroups[group][0]:
+            if ((group, courier), (), restaurant) not in untimedArcData:
+                arcData = EntryUntimedArcData(group, courier, restaurant)
+                if arcData is not None:
+                    untimedArcData[((group, courier), (), restaurant)] = arcData
+                    newUntimedArcs.append(((group, courier), (), restaurant))
+    
+    AddUntimedArcsToModel(newUntimedArcs)
+    print('Added order', order, len(newSequences), 'sequences', len(newUntimedArcs), 'untimed arcs', time() - eventStartTime)
+
+def AddCourier(courier, data):
+    """
+    Add a new courier to the kept model
+    data is [x, y, onTime, offTime], as in couriers.txt
+    
+    The courier joins the group for its shift, which is created if it doesn't
+    exist. Only untimed arcs that didn't exist for the group before are
+    generated; existing arcs keep their time windows, even if the new courier
+    could get to them earlier.
+    """
+    eventStartTime = time()
+    courierData[courier] = list(data)
+    if courierData[courier][3] > globalOffTime:
+        print('Courier ' + str(courier) + ' finishes after the end of the day, using off time ' + str(globalOffTime))
+        courierData[courier][3] = globalOffTime
+    _, _, onTime, offTime = courierData[courier]
+    if not groupCouriersByOffTime:
+        group = courier
+    elif groupCouriersByOnTime:
+        group = (onTime, offTime)
+    else:
+        group = offTime
+    shiftPay = (offTime - onTime) * minPayPerHour / 60
+    
+    courierClasses[courier] = [courier]
+    courierMultiplicity[courier] = 1
+    doesThisCourierStart[courier] = m.addVar(vtype=GRB.BINARY)
+    outArcsIffLeaveHome[courier] = m.addConstr(LinExpr() == doesThisCourierStart[courier])
+    outArcsByCourier[courier] = []
+    m.update()
+    newGroup = group not in courierGroups
+    if newGroup:
+        courierGroups[group] = [[], offTime]
+        for node in [(group, 0, 0), (group, 0, globalOffTime)]:
+            nodesInModel.add(node)
+            nodesByOfftimeRestaurantPair.setdefault(node[:2], []).append(node)
+        nodeTimesByCourierRestaurant[(group, 0)] = [0, globalOffTime]
+        if considerObjective:
+            payments[group] = m.addVar(obj=1)
+            paidPerDelivery[group] = m.addConstr(payments[group] >= shiftPay * (1 - doesThisCourierStart[courier]))
+            paidPerTime[group] = m.addConstr(payments[group] >= shiftPay)
+    elif considerObjective:
+        m.chgCoeff(paidPerDelivery[group], doesThisCourierStart[courier], shiftPay)
+        paidPerDelivery[group].RHS += shiftPay
+        paidPerTime[group].RHS += shiftPay
+    courierGroups[group][0].append(courier)
+    
+    newUntimedArcs = []
+    for (sequence, nextRestaurant) in sequenceNextRestaurantData:
+        if ((group, 0), sequence, nextRestaurant) not in untimedArcData:
+            arcData = MainUntimedArcData(sequence, nextRestaurant, group)
+            if arcData is not None:
+                untimedArcData[((group, 0), sequence, nextRestaurant)] = arcData
+                newUntimedArcs.append(((group, 0), sequence, nextRestaurant))
+    for sequence in sequenceData:
+        if ((group, 0), sequence, 0) not in untimedArcData:
+            arcData = ExitUntimedArcData(sequence, group)
+            if arcData is not None:
+                untimedArcData[((group, 0), sequence, 0)] = arcData
+                exitUntimedArcsByCourierRestaurant.setdefault((group, arcData[0]), []).append(((group, 0), sequence, 0))
+                newUntimedArcs.append(((group, 0), sequence, 0))
+    for restaurant in RestaurantsReachableByCourier(group, courier):
+        arcData = EntryUntimedArcData(group, courier, restaurant)
+        if arcData is not None:
+            untimedArcData[((group, courier), (), restaurant)] = arcData
+            newUntimedArcs.append(((group, courier), (), restaurant))
+    
+    AddUntimedArcsToModel(newUntimedArcs)
+    if newGroup:
+        AddTimedArcToModel(((group,0), 0, 0, (), 0, globalOffTime), [])
+    print('Added courier', courier, len(newUntimedArcs), 'untimed arcs', time() - eventStartTime)
+
+def AdvanceClock(newTime):
+    """
+    Move the clock forward to newTime. Every arc that has been started by
+    newTime is fixed to its value in the current plan, as is every courier's
+    decision to start work if their shift has begun.
+    """
+    if len(onlinePlan) == 0:
+        print('Error: no plan to fix the clock against!')
+        return
+    m.update()
+    while len(onlineArcHeap) > 0 and onlineArcHeap[0][0] < newTime:
+        _, _, arc = heapq.heappop(onlineArcHeap)
+        if arc[1] == 0 and arc[0][1] == 0:
+            # Waiting at home, not part of any constraint
+            continue
+        variable = arcs[arc]
+        # Arcs added since the plan was made can't be used in the past
+        value = round(onlinePlan[variable.index]) if variable.index < len(onlinePlan) else 0
+        variable.LB = value
+        variable.UB = value
+    for courier in courierData:
+        if courier not in onlineFixedCouriers and courierData[courier][2] < newTime:
+            variable = doesThisCourierStart[courier]
+            value = round(onlinePlan[variable.index]) if variable.index < len(onlinePlan) else 0
+            variable.LB = value
+            variable.UB = value
+            onlineFixedCouriers.add(courier)
+
+def ReoptimiseOnline():
+    # Re-solve the kept model within the latency budget, starting from the previous plan
+    reoptimiseStartTime = time()
+    m.update()
+    if len(onlinePlan) > 0:
+        m.setAttr('Start', m.getVars()[:len(onlinePlan)], onlinePlan)
+    m.setParam('TimeLimit', onlineLatencyBudget)
+    m.optimize(Callback)
+    RecordOnlinePlan()
+    if m.SolCount > 0:
+        print('Re-optimised, objective ' + str(m.ObjVal) + ', time ' + str(time() - reoptimiseStartTime))
+    else:
+        print('Error: no plan found within the latency budget!', time() - reoptimiseStartTime)
+
+def PlacementTime(order):
+    return pendingOnlineOrders[order][2]
+
+if onlineMode:
+    StartOnlineMode()
+    for order in sorted(pendingOnlineOrders, key=PlacementTime):
+        AdvanceClock(PlacementTime(order))
+        AddOrder(order, pendingOnlineOrders[order])
+        ReoptimiseOnline()
+    print('Online mode complete, time = ' + str(time() - programStartTime))
+    if telemetryFile is not None:
+        StopTelemetry()
+
 # ============================================================================
 # Solution results
 # ============================================================================
@@ -979,33 +2054,42 @@ usedUntimedArcsByGroup = {g: [] for g in courierGroups}
 journeysByGroup = {}
 journeySummariesByGroup = {}
 def SummariseModel():
-    for arc in arcs:
-        if arcs[arc].x > 0.01 and (arc[3] != () or arc[1] != arc[4]):
+    usedUntimedArcsByGroup.clear()
+    usedUntimedArcsByGroup.update({g: [] for g in courierGroups})
+    journeysByGroup.clear()
+    # Read every arc's value at once, and keep the used arcs that aren't waiting arcs
+    values = m.getAttr('X', list(arcs.values()))
+    usedMask = [value > 0.01 and (arc[3] != () or arc[1] != arc[4]) for (arc, value) in zip(arcs, values)]
+    for (arc, value) in zip(itertools.compress(arcs, usedMask), itertools.compress(values, usedMask)):
+        # Entry arcs of courier classes can be used more than once
+        for _ in range(max(1, round(value))):
             usedUntimedArcsByGroup[arc[0][0]].append((arc[0], arc[3], arc[4]))
     for g in usedUntimedArcsByGroup:
         usedUntimedArcsByGroup[g].sort(key=UntimedArcDepTime)
         journeys = {} # {c: [currentRestaurant, currentTime, [timedArcsInJourney]]}
+        # Couriers by the restaurant they are at, as heaps of (currentTime, journey number, c)
+        # The journey number breaks ties in favour of the courier that started first
+        couriersAtRestaurant = defaultdict(list)
         for arc in usedUntimedArcsByGroup[g]:
             if arc[0][1] != 0:
-                if arc[0][1] not in journeys:
-                    journeys[arc[0][1]] = [arc[2], untimedArcData[arc][1] + untimedArcData[arc][3], [arc]]
+                # Give the entry arc to the next courier in the class without a journey
+                couriersLeft = [c for c in courierClasses[arc[0][1]] if c not in journeys]
+                if len(couriersLeft) > 0:
+                    journeys[couriersLeft[0]] = [arc[2], untimedArcData[arc][1] + untimedArcData[arc][3], [arc]]
+                    heapq.heappush(couriersAtRestaurant[arc[2]], (journeys[couriersLeft[0]][1], len(journeys), couriersLeft[0]))
                 else:
                     print('Double-up of courier!', g, arc[0][1])
             else:
-                bestCourier = 0
-                bestTime = globalOffTime
-                reqRestaurant = untimedArcData[arc][0]
-                for c in journeys:
-                    if journeys[c][0] == reqRestaurant and journeys[c][1] < bestTime:
-                        bestCourier = c
-                        bestTime = journeys[c][1]
-                if bestCourier == 0:
-                    
+                # The courier at the departure restaurant that got there first takes the arc
+                waitingCouriers = couriersAtRestaurant[untimedArcData[arc][0]]
+                if len(waitingCouriers) == 0 or waitingCouriers[0][0] >= globalOffTime:
                     print('Error: No courier found!', g, arc, journeys)
                 else:
+                    _, journeyNumber, bestCourier = heapq.heappop(waitingCouriers)
                     journeys[bestCourier][0] = arc[2]
                     journeys[bestCourier][1] = min(journeys[bestCourier][1], untimedArcData[arc][1]) + untimedArcData[arc][3]
                     journeys[bestCourier][2].append(arc)
+                    heapq.heappush(couriersAtRestaurant[arc[2]], (journeys[bestCourier][1], journeyNumber, bestCourier))
         journeysByGroup[g] = journeys
         for c in journeys:
             summary = "0"
@@ -1015,3 +2099,85 @@ def SummariseModel():
                 summary += " -> " + str(arc[2])
             journeySummariesByGroup[c] = summary
             print(c, summary)
+
+def WriteSolutionRoutes(fileName):
+    """
+    Write the journeys found by SummariseModel to fileName as JSON, by column,
+    with a row for every delivered order
+    pickupTime is when the courier leaves the restaurant with the order, and
+    deliveryTime is when it gets to the customer
+    """
+    columns = {'courier': [], 'group': [], 'stop': [], 'order': [], 'restaurant': [], 'pickupTime': [], 'deliveryTime': []}
+    for g in journeysByGroup:
+        for c in journeysByGroup[g]:
+            arrivalTime = courierData[c][2]
+            stop = 0
+            for arc in journeysByGroup[g][c][2]:
+                restaurant, earliestLeavingTime, _, travelTime = untimedArcData[arc]
+                if arc[1] == ():
+                    arrivalTime = earliestLeavingTime + travelTime
+                    continue
+                departureTime = max(arrivalTime, earliestLeavingTime)
+                location = restaurantData[restaurant]
+                deliveryTime = departureTime + pickupServiceTime / 2
+                for order in arc[1]:
+                    deliveryTime += TravelTime(location, orderData[order])
+                    for (column, value) in [('courier', c), ('group', g), ('stop', stop), ('order', order), ('restaurant', restaurant),
+                                            ('pickupTime', departureTime), ('deliveryTime', deliveryTime)]:
+                        columns[column].append(value)
+                    deliveryTime += dropoffServiceTime
+                    location = orderData[order]
+                    stop += 1
+                arrivalTime = departureTime + travelTime
+    with open(fileName, 'w') as file:
+        json.dump(columns, file)
+    print('Wrote ' + str(len(columns['order'])) + ' deliveries to ' + fileName)
+
+def CommitRollingHorizonWindow():
+    """
+    Fix the decisions of the solved window, and move on to the next one
+    
+    Every arc that a courier leaves on before the end of the window is
+    committed, and the orders on it are marked as delivered. The courier then
+    becomes available at the restaurant it was heading to (or at its last
+    delivery, for an exit arc) when it gets there. Couriers that didn't
+    commit to any arcs become available at the end of the window. Missed
+    orders are kept apart from the delivered ones.
+    """
+    SummariseModel()
+    deliveredOrders = list(rollingHorizonState['deliveredOrders'])
+    # Couriers whose shifts have already finished keep their old state
+    courierStates = dict(rollingHorizonState['courierStates'])
+    courierStates.update({str(c): courierData[c][:2] + [max(courierData[c][2], windowEnd)] for c in courierData})
+    for g in journeysByGroup:
+        for c in journeysByGroup[g]:
+            arrivalTime = courierData[c][2]
+            for arc in journeysByGroup[g][c][2]:
+                _, earliestLeavingTime, _, travelTime = untimedArcData[arc]
+                if arc[1] == ():
+                    # Entry arc, only committed once the courier delivers something
+                    arrivalTime = earliestLeavingTime + travelTime
+                    continue
+                departureTime = max(arrivalTime, earliestLeavingTime)
+                if departureTime >= windowEnd:
+                    break
+                arrivalTime = departureTime + travelTime
+                deliveredOrders += list(arc[1])
+                if arc[2] != 0:
+                    location = restaurantData[arc[2]]
+                else:
+                    location = orderData[arc[1][-1]]
+                courierStates[str(c)] = [location[0], location[1], arrivalTime]
+    AdvanceRollingHorizon(deliveredOrders, rollingHorizonState['missedOrders'] + missedOrders, courierStates)
+
+if rollingHorizon and m.SolCount == 0:
+    # Leave the state file at the start of this window, so it can be re-run
+    print('Error: No solution found for window ' + str(windowStart) + '-' + str(windowEnd) + ', status ' + str(m.Status) + '!')
+    sys.exit()
+
+if solutionFile is not None:
+    SummariseModel()
+    WriteSolutionRoutes(solutionFile)
+
+if rollingHorizon:
+    CommitRollingHorizonWindow()
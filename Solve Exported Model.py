@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Solve a model exported by Optimisation Code.py (with exportModel on), without
+building it again
+
+Usage: python "Solve Exported Model.py" [instance]
+"""
+
+import sys
+from collections import defaultdict
+from time import time
+from MDRPSolver import LoadExportedModel, Callback, ApplyTunedParameters, StartTelemetry, StopTelemetry
+
+grubhubInstance = '0o100t100s1p100'
+exportDirectory = 'ExportedModels/'
+if len(sys.argv) > 1:
+    grubhubInstance = sys.argv[1]
+telemetryFile = 'Telemetry_' + grubhubInstance + '.tsv' # None to turn off
+programStartTime = time()
+
+m, arcs = LoadExportedModel(exportDirectory + grubhubInstance)
+print('Loaded ' + str(len(arcs)) + ' timed arcs, time = ' + str(time() - programStartTime))
+
+m.setParam('Method', 2)
+m.setParam('LazyConstraints', 1)
+m.setParam('OutputFlag', 1)
+ApplyTunedParameters(m, 'MIP')
+if telemetryFile is not None:
+    StartTelemetry(telemetryFile)
+m.optimize(Callback)
+if telemetryFile is not None:
+    StopTelemetry()
+
+print('Time = ' + str(time() - programStartTime))
+
+if m.SolCount > 0:
+    print('Objective = ' + str(m.ObjVal))
+    # Used untimed arcs by courier group, in the order the timed arcs leave
+    usedArcsByGroup = defaultdict(list)
+    for arc in sorted(arcs, key=lambda arc: arc[2]):
+        if arcs[arc].x > 0.01 and (arc[3] != () or arc[1] != arc[4]):
+            usedArcsByGroup[arc[0][0]].append((arc[0], arc[3], arc[4]))
+    for g in usedArcsByGroup:
+        print(g, usedArcsByGroup[g])
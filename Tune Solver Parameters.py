@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tune the Gurobi parameters on models exported by Optimisation Code.py (with
+exportModel on), and save the best found for each size class
+
+Usage: python "Tune Solver Parameters.py" [instance1 instance2 ...]
+With no instances given, every model in exportDirectory is used.
+
+Gurobi's own tuning tool can't run the lazy constraint callback, so this does
+a coordinate search instead: starting from the parameters the main script
+uses, each parameter in turn is set to each of its candidate values, and the
+best value is kept before moving on to the next parameter. A run's score is
+its runtime, or for runs that hit the time limit, the time limit scaled up by
+the remaining gap. A set of parameters is scored by its mean over the
+instances in the size class.
+
+The LP parameters are used for the VI rounds, so they are tuned on the LP
+exported before the first VI round. For models exported without it, the
+relaxation of the final model is used instead. That has every VI added, so it
+is only a proxy for the VI round LPs.
+"""
+
+import json
+import os
+import sys
+from time import time
+from gurobipy import GRB
+from MDRPSolver import LoadExportedModel, LoadExportedFirstRoundLP, Callback, SizeClass
+
+exportDirectory = 'ExportedModels/'
+tunedParametersFile = 'TunedParameters.json'
+tuningTimeLimit = 600 # seconds per solve
+programStartTime = time()
+
+# Candidate values for each parameter, in the order they are searched
+MIPParameterValues = {
+    'Method': [2, 1, 0, 3],
+    'Presolve': [-1, 0, 1, 2],
+    'Cuts': [-1, 0, 1, 2, 3],
+    'MIPFocus': [0, 1, 2, 3],
+    'Threads': [0, 1, 2, 4, 8],
+    'Heuristics': [0.05, 0, 0.2, 0.5]
+}
+# The VI rounds only solve the LP relaxation
+LPParameterValues = {
+    'Method': [-1, 0, 1, 2, 3],
+    'Presolve': [-1, 0, 1, 2],
+    'Threads': [0, 1, 2, 4, 8]
+}
+
+if len(sys.argv) > 1:
+    trainingInstances = sys.argv[1:]
+else:
+    trainingInstances = sorted(fileName[:-len('.mps.bz2')] for fileName in os.listdir(exportDirectory) if fileName.endswith('.mps.bz2'))
+
+def Score(instance, stage, parameters):
+    # Load the model fresh each time, so no lazy constraints or solutions carry over
+    if stage == 'LP':
+        model = LoadExportedFirstRoundLP(exportDirectory + instance)
+        if model is None:
+            model = LoadExportedModel(exportDirectory + instance)[0].relax()
+    else:
+        model, _ = LoadExportedModel(exportDirectory + instance)
+    model.setParam('OutputFlag', 0)
+    model.setParam('TimeLimit', tuningTimeLimit)
+    for (parameter, value) in parameters.items():
+        model.setParam(parameter, value)
+    if stage == 'LP':
+        model.optimize()
+    else:
+        model.setParam('LazyConstraints', 1)
+        model.optimize(Callback)
+    if model.Status == GRB.OPTIMAL:
+        return model.Runtime
+    if stage == 'MIP' and model.SolCount > 0:
+        return tuningTimeLimit * (1 + min(model.MIPGap, 1))
+    return tuningTimeLimit * 2
+
+def MeanScore(instances, stage, parameters):
+    return sum(Score(instance, stage, parameters) for instance in instances) / len(instances)
+
+def CoordinateSearch(instances, stage, parameterValues):
+    """
+    Returns the best parameters found for the instances, with a value for
+    every parameter in parameterValues, and their mean score
+    """
+    bestParameters = {parameter: parameterValues[parameter][0] for parameter in parameterValues}
+    bestScore = MeanScore(instances, stage, bestParameters)
+    print(stage, 'starting score', bestScore, bestParameters)
+    for parameter in parameterValues:
+        for value in parameterValues[parameter][1:]:
+            parameters = dict(bestParameters)
+            parameters[parameter] = value
+            score = MeanScore(instances, stage, parameters)
+            print(stage, parameter, value, score, int(time() - programStartTime))
+            if score < bestScore:
+                bestScore = score
+                bestParameters = parameters
+    return (bestParameters, bestScore)
+
+# Group the training instances by size class
+instancesBySizeClass = {}
+for instance in trainingInstances:
+    model, _ = LoadExportedModel(exportDirectory + instance)
+    instancesBySizeClass.setdefault(SizeClass(model.NumVars), []).append(instance)
+    model.dispose()
+print('Training instances by size class:', instancesBySizeClass)
+
+# Keep what was tuned before for size classes not in this training set
+tunedParameters = {}
+if os.path.exists(tunedParametersFile):
+    with open(tunedParametersFile) as file:
+        tunedParameters = json.load(file)
+
+for sizeClass in instancesBySizeClass:
+    instances = instancesBySizeClass[sizeClass]
+    print()
+    print('Tuning', sizeClass, 'size class on', len(instances), 'instances')
+    LPParameters, LPScore = CoordinateSearch(instances, 'LP', LPParameterValues)
+    MIPParameters, MIPScore = CoordinateSearch(instances, 'MIP', MIPParameterValues)
+    tunedParameters[sizeClass] = {'LP': LPParameters, 'MIP': MIPParameters}
+    print(sizeClass, 'LP', LPScore, LPParameters)
+    print(sizeClass, 'MIP', MIPScore, MIPParameters)
+    # Save as each size class finishes, so a long run isn't lost
+    with open(tunedParametersFile, 'w') as file:
+        json.dump(tunedParameters, file, indent=4)
+
+print('Time = ' + str(time() - programStartTime))